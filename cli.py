@@ -42,11 +42,23 @@ def get_codeql(args, location=None):
     distdir,
     additional_packs=args.additional_packs,
     search_path=s,
+    use_cli_server=not args.no_cli_server,
+    use_not_found_cache=not args.no_registry_cache,
+    prefer_cache=getattr(args, 'prefer_cache', False),
+    offline=getattr(args, 'offline', False),
   )
   info(f'CodeQL distribution detected at "{codeql.distdir}".')
+  if codeql.offline:
+    info('Running offline, packs are only looked up locally.')
   return codeql
 
 
+def registry_env(codeql):
+  # a callable, so that the token is only looked up once the cli
+  # server is actually started
+  return None if codeql.offline else codeql.session.env
+
+
 def get_pack_info(args):
   if args.language:
     lang = util.get_pack_lang(args.pack)
@@ -91,21 +103,27 @@ def download(args):
     args.outdir if args.outdir else '.'
   )
 
-  pack = codeql.download_pack(
-    args.name,
-    args.version,
-    match_cli=True
-  )
+  with codeql.cli_server(env=registry_env(codeql)):
+    pack = codeql.download_pack(
+      args.name,
+      args.version,
+      match_cli=True
+    )
 
   if pack:
     info('Successfully downloaded pack!')
   else:
-    error(f'Pack "{args.name}@{args.version}" not found in registry!')
+    error(
+      f'Pack "{args.name}@{args.version}" not found ' +
+      ('locally!' if codeql.offline else 'in registry!')
+    )
 
   if args.outdir:
-    shutil.copytree(
+    util.copy_tree(
       pack,
       args.outdir,
+      hardlink=args.hardlink,
+      verbose=True,
     )
 
 
@@ -133,30 +151,47 @@ def set_ql_meta(args):
   if not (args.delete or args.meta):
     error('You must set one of --meta or --delete!')
 
-  for qlf in args.qlfiles:
-    for k, v in args.meta:
-      util.set_ql_meta(qlf, k, v)
-    for k in args.delete:
-      util.delete_ql_meta(qlf, k)
+  util.edit_ql_metas(
+    selected_qlfiles(args, args.pack),
+    [tuple(kv) for kv in args.meta],
+    args.delete,
+  )
+
+
+def selected_qlfiles(args, ppath):
+  # the given files plus the queries of ppath (if any) matching all
+  # --where selectors
+  qlfiles = list(args.qlfiles)
+  if ppath:
+    qlfiles.extend(util.select_queries(ppath, args.where))
+  elif args.where:
+    error('--where requires --pack!')
+  # the same file may be given by different paths
+  qlfiles = util.unique_paths(qlfiles)
+  if not qlfiles:
+    error('No files given or selected!')
+  return qlfiles
 
 
 def ql_import(args):
-  for qlf in args.qlfiles:
-    for m in args.modules:
-      util.ql_import(
-        qlf,
-        m,
-        visible=args.visible
-      )
+  qlfiles = selected_qlfiles(args, args.pack)
+  for qlf, added in zip(
+    qlfiles,
+    util.ql_imports(qlfiles, args.modules, visible=args.visible)
+  ):
+    skipped = [m for m in args.modules if m not in added]
+    if skipped:
+      info(f'"{qlf}" already imports {", ".join(skipped)}.')
 
 
 def customize(args):
   util.customize(
     args.pack,
     args.settingsfile,
-    args.qlfiles,
+    selected_qlfiles(args, args.pack if args.where else None),
     args.priority,
-    args.modules
+    args.modules,
+    args.chunk_settings,
   )
 
 
@@ -164,13 +199,18 @@ def install(args):
   codeql = get_codeql(args, args.pack)
 
   info('Updating lock file...')
-  codeql.make_lockfile(
-    args.pack,
-    join(tempdir, 'qlpack.yml.bak'),
-    match_cli=True,
-    mode=args.mode
-  )
+  with codeql.cli_server(env=registry_env(codeql)):
+    codeql.make_lockfile(
+      args.pack,
+      join(tempdir, 'qlpack.yml.bak'),
+      match_cli=True,
+      mode=args.mode
+    )
 
+  if codeql.offline:
+    # "codeql pack install" may download the locked packs
+    warning('Not installing the dependencies in offline mode, only the lock file was updated.')
+    return
   codeql.install(args.pack)
 
 
@@ -179,12 +219,21 @@ def create(args):
     error('No output directory given!')
 
   codeql = get_codeql(args, args.pack)
-  tmppackdir = join(tempdir, 'outpack')
+  build_cache = None if args.no_build_cache else util.BuildCache(
+    args.build_cache,
+    args.build_cache_size * 1024**2,
+  )
 
   if args.in_place:
-    codeql.create_inplace(args.pack, tmppackdir)
+    codeql.create_inplace(args.pack, build_cache, args.base)
   else:
-    codeql.create(args.pack, args.outdir, tmppackdir)
+    codeql.create(
+      args.pack,
+      args.outdir,
+      join(tempdir, 'outpack'),
+      build_cache,
+      args.base,
+    )
 
 
 def test(args):
@@ -201,7 +250,9 @@ def test(args):
 
 def autoversion(args):
   codeql = get_codeql(args, args.pack)
-  sys.exit(codeql.autoversion(args.pack, args.mode, args.fail))
+  with codeql.cli_server(env=registry_env(codeql)):
+    ret = codeql.autoversion(args.pack, args.mode, args.fail)
+  sys.exit(ret)
 
 
 def publish(args):
@@ -216,14 +267,19 @@ def publish(args):
     'pack', 'publish',
     '-vv',
     '--file', out,
-    env=util.env_with_token(),
+    env=codeql.session.env(),
   )
+  util.forget_not_found(util.get_pack_name(args.pack))
+
+
+def stage(args):
+  util.stage_pack(args.base, args.outdir, hardlink=args.hardlink)
 
 
 def make_min_db(args):
   codeql = get_codeql(args, args.db)
   codedir = join(tempdir, 'mindb')
-  shutil.copytree(
+  util.copy_tree(
     join(
       util.templatedir(),
       args.language,
@@ -264,6 +320,24 @@ def mustbefile(path):
   return path
 
 
+def mustbeselector(string):
+  try:
+    util.QuerySelector(string)
+  except ValueError as e:
+    error(str(e))
+  return string
+
+
+def mustbepositiveint(string):
+  try:
+    value = int(string)
+  except ValueError:
+    value = 0
+  if value < 1:
+    error(f'"{string}" is not a positive integer!')
+  return value
+
+
 def mustbeqlorqllfile(path):
   if not (util.is_qlfile(path) or util.is_qllfile(path)):
     error(f'"{path}" is not a CodeQL query or library file!')
@@ -324,6 +398,20 @@ def main():
     help='Output directory',
   )
 
+  wherebase = argparse.ArgumentParser(add_help=False)
+  wherebase.add_argument(
+    '--where', '-w',
+    action='append',
+    default=[],
+    required=False,
+    type=mustbeselector,
+    metavar='selector',
+    help='Select the queries of the pack whose metadata matches ' +
+         '"key=value", "key!=value" (different or missing) or ' +
+         '"key~word" (e.g. "tags~security"). Repeatable, all ' +
+         'selectors must match.',
+  )
+
   packbase = argparse.ArgumentParser(add_help=False)
   packbase.add_argument(
     'pack',
@@ -353,6 +441,37 @@ def main():
     default=None,
     help='Additional search path for QL packs. Repeatable.',
   )
+  distbase.add_argument(
+    '--no-cli-server',
+    required=False,
+    action='store_true',
+    help='Run every CodeQL command in a process of its own, instead ' +
+         'of sharing a single "codeql execute cli-server" process.',
+  )
+  distbase.add_argument(
+    '--no-registry-cache',
+    required=False,
+    action='store_true',
+    help='Always ask the registry for a pack, even if it was found ' +
+         'to be missing recently.',
+  )
+  # for the commands which look up packs in the registry
+  resolvebase = argparse.ArgumentParser(add_help=False)
+  resolvebase.add_argument(
+    '--prefer-cache',
+    required=False,
+    action='store_true',
+    help='Use matching packs from the package cache or the search ' +
+         'path and only download packs which are not available locally.',
+  )
+  resolvebase.add_argument(
+    '--offline',
+    required=False,
+    action='store_true',
+    help='Never contact the registry. Packs are only looked up in the ' +
+         'package cache and the search path. install then only updates ' +
+         'the lock file.',
+  )
 
   parser = argparse.ArgumentParser(
     prog='tailor',
@@ -393,7 +512,7 @@ def main():
 
   sp = subparsers.add_parser(
     'download',
-    parents=[distbase, outbase],
+    parents=[distbase, resolvebase, outbase],
     help='Download a (Code)QL pack from the registry.',
     description='Download a (Code)QL pack from the registry.',
   )
@@ -408,6 +527,14 @@ def main():
     default='*',
     help='The version of the package to download.',
   )
+  sp.add_argument(
+    '--hardlink',
+    action='store_true',
+    help='Hardlink the files of the pack in the package cache into ' +
+         'the output directory instead of copying them. Faster, but ' +
+         'modifying them in place modifies the cached pack as well, so ' +
+         'only use it for output which is never modified.',
+  )
   sp.set_defaults(func=download)
 
   sp = subparsers.add_parser(
@@ -448,6 +575,7 @@ def main():
 
   sp = subparsers.add_parser(
     'set-ql-meta',
+    parents=[wherebase],
     help='Modify the metadata values in a CodeQL query.',
     description='Modify the metadata values in a CodeQL query.',
   )
@@ -466,17 +594,25 @@ def main():
     required=False,
     help='The meta key to delete. Repeatable.',
   )
+  sp.add_argument(
+    '--pack',
+    required=False,
+    type=mustbepack,
+    help='Also process the queries of this pack which match the ' +
+         '--where selectors (all of them, if none are given).',
+  )
   sp.add_argument(
     'qlfiles',
     metavar='qlfile',
-    nargs='+',
+    nargs='*',
     type=mustbeqlfile,
-    help='One or more query files.',
+    help='Zero or more query files.',
   )
   sp.set_defaults(func=set_ql_meta)
 
   sp = subparsers.add_parser(
     'ql-import',
+    parents=[wherebase],
     help='Import a module into a CodeQL query or library file.',
     description='Import a module into a CodeQL query or library file.',
   )
@@ -494,19 +630,26 @@ def main():
     required=False,
     help='The imported symbols will be visible in the target module, instead of being hidden (default).',
   )
+  sp.add_argument(
+    '--pack',
+    required=False,
+    type=mustbepack,
+    help='Also process the queries of this pack which match the ' +
+         '--where selectors (all of them, if none are given).',
+  )
   sp.add_argument(
     'qlfiles',
     metavar='qlfile',
-    nargs='+',
+    nargs='*',
     type=mustbeqlorqllfile,
-    help='One or more query or library files.',
+    help='Zero or more query or library files.',
   )
   sp.set_defaults(func=ql_import)
 
 
   sp = subparsers.add_parser(
     'customize',
-    parents=[packbase],
+    parents=[packbase, wherebase],
     help='Generate and inject CodeQL into an existing pack, based on a settings file.',
     description='Generate and inject CodeQL into an existing pack, based on a settings file.',
   )
@@ -524,6 +667,16 @@ def main():
     required=False,
     help='The name of a fully-qualified module to import into the generated settings qll file. Repeatable.',
   )
+  sp.add_argument(
+    '--chunk-settings',
+    metavar='SIZE',
+    type=mustbepositiveint,
+    required=False,
+    default=None,
+    help='Spread the settings over several predicates of at most SIZE ' +
+         f'values each (e.g. {util.SETTINGS_CHUNK_SIZE}), which may ' +
+         'compile faster for very large settings files.',
+  )
   sp.add_argument(
     'settingsfile',
     type=mustbefile,
@@ -532,16 +685,17 @@ def main():
   sp.add_argument(
     'qlfiles',
     metavar='qlfile',
-    nargs='+',
+    nargs='*',
     type=mustbeqlorqllfile,
-    help='One or more query or library files.',
+    help='Zero or more query or library files (in addition to the ' +
+         'queries selected with --where).',
   )
   sp.set_defaults(func=customize)
 
 
 #  sp = subparsers.add_parser(
 #    'install',
-#    parents=[distbase, packbase],
+#    parents=[distbase, resolvebase, packbase],
 #    help='Install a (Code)QL pack\'s dependencies.',
 #    description='Install a (Code)QL pack\'s dependencies.',
 #  )
@@ -566,6 +720,35 @@ def main():
     action='store_true',
     help='Replace the given pack with the result (DESTRUCTIVE OPERATION!).',
   )
+  sp.add_argument(
+    '--base', '-b',
+    required=False,
+    type=mustbepack,
+    help='The compiled pack the given pack was derived from. Only ' +
+         'queries affected by the changes to it are compiled, the ' +
+         'others keep their precompiled form.',
+  )
+  sp.add_argument(
+    '--build-cache',
+    required=False,
+    default=os.environ.get('TAILOR_BUILD_CACHE', None),
+    help='Directory in which to keep compiled packs for reuse. ' +
+         'Defaults to ${TAILOR_BUILD_CACHE} or a directory in the tailor cache.',
+  )
+  sp.add_argument(
+    '--build-cache-size',
+    required=False,
+    type=int,
+    default=2048,
+    help='Maximum size of the build cache in MiB. Least recently ' +
+         'used builds are evicted first.',
+  )
+  sp.add_argument(
+    '--no-build-cache',
+    required=False,
+    action='store_true',
+    help='Always compile the pack, do not use or fill the build cache.',
+  )
   sp.set_defaults(func=create)
 
 #  sp = subparsers.add_parser(
@@ -610,6 +793,36 @@ def main():
   )
   sp.set_defaults(func=publish)
 
+  sp = subparsers.add_parser(
+    'stage',
+    help='Create a working copy of a pack for customization.',
+    description='Create a working copy of a pack for customization. ' +
+                'Where the file system supports it, the copy shares the ' +
+                'files\' data with the given pack until they are modified ' +
+                '(reflinks).',
+  )
+  sp.add_argument(
+    '--hardlink',
+    action='store_true',
+    help='Hardlink the files instead of copying them. The tailor ' +
+         'commands replace a file by a copy before modifying it, but ' +
+         'any other in-place modification (e.g. by an editor or a ' +
+         'shell redirection) modifies the given pack as well. ' +
+         'Incremental compilation (create --base) is not possible ' +
+         'for such a copy.',
+  )
+  sp.add_argument(
+    'base',
+    type=mustbepack,
+    help='The pack to create a working copy of.',
+  )
+  sp.add_argument(
+    'outdir',
+    type=mustnotexist,
+    help='The output directory',
+  )
+  sp.set_defaults(func=stage)
+
   sp = subparsers.add_parser(
     'make-min-db',
     parents=[distbase],
@@ -12,6 +12,7 @@ from urllib.request import (
 import sys
 import os
 import json
+import socket
 from fnmatch import fnmatch
 from datetime import datetime
 
@@ -37,6 +38,7 @@ def request(
   method: str = "GET",
   headers: dict = {},
   data: bytes = None,
+  timeout: float = None,
 ):
 
   method = method.upper()
@@ -56,7 +58,10 @@ def request(
     method=method,
   )
 
-  with opener.open(req) as resp:
+  with opener.open(
+    req,
+    timeout=socket.getdefaulttimeout() if timeout is None else timeout,
+  ) as resp:
     return (
       resp.status,
       resp.headers,
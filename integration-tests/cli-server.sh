@@ -0,0 +1,57 @@
+#!/bin/sh
+# Runs tailor's cli server client against a stand-in server.
+set -eu
+
+HERE="$(CDPATH= cd -- "$(dirname -- "$0")" && pwd)"
+export PYTHONPATH="${HERE}/..:${HERE}/../lib"
+export SPAWN_LOG="$(mktemp)"
+trap 'rm -f "${SPAWN_LOG}"' EXIT
+
+python3 - "${HERE}/cli-server" <<'PY'
+import os
+import sys
+import util
+from subprocess import CalledProcessError
+
+codeql = util.CodeQL(sys.argv[1])
+
+def spawned():
+  with open(os.environ['SPAWN_LOG']) as f:
+    return len(f.readlines())
+
+def output(*args):
+  lines = []
+  codeql(*args, outconsumer=lambda cmd, s: lines.extend(s))
+  return ''.join(lines)
+
+with codeql.cli_server():
+  first = codeql.server
+  assert '"a", "b"' in output('a', 'b')
+  assert 'Resolving version' in output('version', '--format=json')
+
+  # a failing command terminates the server, it is a failure of that
+  # command only and the next command gets a new server
+  try:
+    codeql('fail', 'not found')
+    assert False, 'command did not fail'
+  except CalledProcessError:
+    pass
+  try:
+    codeql('crash')
+    assert False, 'command did not fail'
+  except CalledProcessError:
+    pass
+  assert '"c"' in output('c')
+  assert codeql.server is not first
+
+  # a server which died between two commands is replaced transparently
+  codeql.server.proc.kill()
+  codeql.server.proc.wait()
+  assert '"d"' in output('d')
+  assert spawned() == 0, 'commands ran in separate processes'
+
+# without the server, commands run in processes of their own
+assert '"e"' in output('e')
+assert spawned() == 1
+print('OK')
+PY
@@ -0,0 +1,52 @@
+# A stand-in for "codeql execute cli-server", speaking the same
+# protocol: JSON encoded arguments terminated by a NUL byte on stdin,
+# the command's output terminated by a NUL byte on stdout. Like the
+# real server, it terminates when a command fails. With arguments, it
+# runs a single command like the real "codeql" does.
+#
+# Commands:
+#   version --format=json    prints a version
+#   fail <message>           fails with a fatal error
+#   crash                    terminates without any output
+#   anything else            echoes its arguments as JSON
+import sys
+import json
+
+
+def run(args):
+  if args[:1] == ['fail']:
+    sys.stderr.write(f'A fatal error occurred: {" ".join(args[1:])}\n')
+    sys.stderr.flush()
+    return 2
+  elif args[:1] == ['crash']:
+    return 3
+  elif args[:1] == ['version']:
+    sys.stderr.write('Resolving version...\n')
+    sys.stderr.flush()
+    sys.stdout.write(json.dumps({'version': '2.11.0'}))
+  else:
+    sys.stdout.write(json.dumps({'args': args}))
+  return 0
+
+
+def serve():
+  stdin = sys.stdin.buffer
+  buf = bytearray()
+  while True:
+    c = stdin.read(1)
+    if not c:
+      return 0
+    if c != b'\0':
+      buf.extend(c)
+      continue
+    ret = run(json.loads(buf))
+    buf.clear()
+    if ret != 0:
+      return ret
+    sys.stdout.write('\0')
+    sys.stdout.flush()
+
+
+if len(sys.argv) > 1:
+  sys.exit(run(sys.argv[1:]))
+sys.exit(serve())
@@ -0,0 +1,47 @@
+#!/bin/sh
+# Times hashing a synthetic pack (see util.hash_dir) without and with
+# the persistent digest cache. Needs no CodeQL CLI.
+# Usage: hash-benchmark.sh [files]
+set -eu
+
+HERE="$(CDPATH= cd -- "$(dirname -- "$0")" && pwd)"
+export PYTHONPATH="${HERE}/..:${HERE}/../lib"
+WORKDIR="$(mktemp -d)"
+trap 'rm -rf "${WORKDIR}"' EXIT
+# a digest cache of its own, which starts out empty
+export TAILOR_CACHE_DIR="${WORKDIR}/cache"
+
+python3 - "${WORKDIR}" "$@" <<'PY'
+import os
+import sys
+import time
+from os.path import join
+import util
+
+workdir = sys.argv[1]
+files = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+pack = join(workdir, 'pack')
+# files modified within the last seconds are never cached, so the
+# tree is dated back to let the warm run use the cache
+past = time.time() - 3600
+for i in range(files):
+  d = join(pack, 'queries', f'dir{i // 100}')
+  os.makedirs(d, exist_ok=True)
+  path = join(d, f'Query{i}.ql')
+  util.str2file(path, f'/**\n * @id test/query-{i}\n */\n' + 'select 1\n' * 200)
+  os.utime(path, (past, past))
+
+def hash_seconds():
+  start = time.monotonic()
+  digest = util.hash_dir(pack)
+  return digest, time.monotonic() - start
+
+cold, coldsecs = hash_seconds()
+warm, warmsecs = hash_seconds()
+if cold != warm:
+  util.error('The cached digest differs from the computed one!')
+
+print('files\tcold (s)\twarm (s)', flush=True)
+print(f'{files}\t{coldsecs:.2f}\t{warmsecs:.2f}', flush=True)
+PY
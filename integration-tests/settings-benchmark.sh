@@ -0,0 +1,78 @@
+#!/bin/sh
+# Compares the compilation times of the plain and the chunked settings
+# QL (see "customize --chunk-settings") for settings of growing size.
+# Usage: settings-benchmark.sh [language [rows...]]
+set -eu
+
+HERE="$(CDPATH= cd -- "$(dirname -- "$0")" && pwd)"
+export PYTHONPATH="${HERE}/..:${HERE}/../lib"
+lang="${1:-java}"
+[ "$#" -gt 0 ] && shift
+WORKDIR="$(mktemp -d)"
+trap 'rm -rf "${WORKDIR}"' EXIT
+
+python3 - "${HERE}/../templates/common/ql/tailor" "${WORKDIR}" "${lang}" "$@" <<'PY'
+import os
+import shutil
+import subprocess
+import sys
+import time
+from os.path import join
+import util
+
+templates, workdir, lang = sys.argv[1:4]
+sizes = [int(n) for n in sys.argv[4:]] or [100, 1000, 10000]
+codeql = os.environ.get('CODEQL', 'gh codeql').split()
+
+pack = join(workdir, 'pack')
+shutil.copytree(templates, join(pack, 'tailor'))
+util.str2file(
+  join(pack, 'qlpack.yml'),
+  'name: tailor/settings-benchmark\n' +
+  'version: 0.0.0\n' +
+  f'dependencies:\n  codeql/{lang}-all: "*"\n',
+)
+util.str2file(
+  join(pack, 'Benchmark.ql'),
+  # the dependency on codeql/<lang>-all only provides the dbscheme
+  '/**\n * @kind table\n */\n' +
+  'import tailor.Settings\n' +
+  'import tailor.BenchmarkSettings\n\n' +
+  'select count(string k, string v | v = Tailor::values(k))\n',
+)
+subprocess.run(codeql + ['pack', 'install', pack], check=True)
+
+def compile_seconds():
+  # a fresh compilation cache for every run, so that nothing is reused
+  cache = join(workdir, 'cache')
+  shutil.rmtree(cache, ignore_errors=True)
+  start = time.monotonic()
+  subprocess.run(
+    codeql + [
+      'query', 'compile',
+      f'--compilation-cache={cache}',
+      join(pack, 'Benchmark.ql'),
+    ],
+    check=True,
+    stdout=subprocess.DEVNULL,
+  )
+  return time.monotonic() - start
+
+print('rows\tplain (s)\tchunked (s)', flush=True)
+for n in sizes:
+  # ten keys, each with an equal share of the values
+  settings = {
+    f'key{k}': [f'value{k}_{v}' for v in range(n // 10)]
+    for k in range(10)
+  }
+  seconds = []
+  for chunk_size in (None, util.SETTINGS_CHUNK_SIZE):
+    util.str2file(
+      join(pack, 'tailor', 'BenchmarkSettings.qll'),
+      util.generate_settings_ql(
+        settings, 0, 'BenchmarkSettings', ['tailor.Settings'], chunk_size
+      ),
+    )
+    seconds.append(compile_seconds())
+  print(f'{n}\t{seconds[0]:.1f}\t{seconds[1]:.1f}', flush=True)
+PY
@@ -14,6 +14,7 @@
 
 # This file has been altered from its original form.
 
+import functools
 import re
 
 _double_star_after_invalid_regex = re.compile(r'[^/\\]\*\*')
@@ -21,40 +22,103 @@ _double_star_first_before_invalid_regex = re.compile('^\\*\\*[^/]')
 _double_star_middle_before_invalid_regex = re.compile(r'[^\\]\*\*[^/]')
 
 
-def _match_component(pattern_component, file_name_component):
-    if len(pattern_component) == 0 and len(file_name_component) == 0:
-        return True
-    elif len(pattern_component) == 0:
-        return False
-    elif len(file_name_component) == 0:
-        return pattern_component == '*'
-    elif pattern_component[0] == '*':
-        return _match_component(pattern_component, file_name_component[1:]) or _match_component(pattern_component[1:],
-                                                                                                file_name_component)
-    elif pattern_component[0] == '?':
-        return _match_component(pattern_component[1:], file_name_component[1:])
-    elif pattern_component[0] == '\\':
-        return len(pattern_component) >= 2 and pattern_component[1] == file_name_component[0] and _match_component(
-            pattern_component[2:], file_name_component[1:])
-    elif pattern_component[0] != file_name_component[0]:
-        return False
-    else:
-        return _match_component(pattern_component[1:], file_name_component[1:])
-
-
-def _match_components(pattern_components, file_name_components):
-    if len(pattern_components) == 0 and len(file_name_components) == 0:
-        return True
-    if len(pattern_components) == 0:
-        return False
-    if len(file_name_components) == 0:
-        return len(pattern_components) == 1 and pattern_components[0] == '**'
-    if pattern_components[0] == '**':
-        return _match_components(pattern_components, file_name_components[1:]) or _match_components(
-            pattern_components[1:], file_name_components)
-    else:
-        return _match_component(pattern_components[0], file_name_components[0]) and _match_components(
-            pattern_components[1:], file_name_components[1:])
+def _translate_component(pattern_component):
+    result = []
+    i = 0
+    while i < len(pattern_component):
+        c = pattern_component[i]
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '\\':
+            if i + 1 == len(pattern_component):
+                # a dangling escape character never matches
+                return '(?!)'
+            i += 1
+            result.append(re.escape(pattern_component[i]))
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return ''.join(result)
+
+
+def _translate(pattern_components):
+    if pattern_components == ['**']:
+        return '.*'
+    result = []
+    for i, pattern_component in enumerate(pattern_components):
+        if pattern_component == '**':
+            result.append('(?:[^/]*/)*' if i == 0 else '(?:/[^/]*)*')
+            continue
+        if i > 0 and not (i == 1 and pattern_components[0] == '**'):
+            result.append('/')
+        result.append(_translate_component(pattern_component))
+    return ''.join(result)
+
+
+def _split_pattern(pattern):
+    if _double_star_after_invalid_regex.search(pattern) is not None or _double_star_first_before_invalid_regex.search(
+            pattern) is not None or _double_star_middle_before_invalid_regex.search(pattern) is not None:
+        raise ValueError('** in {} not alone between path separators'.format(pattern))
+    pattern = pattern.rstrip('/')
+    while '**/**' in pattern:
+        pattern = pattern.replace('**/**', '**')
+    return pattern.split('/')
+
+
+def _split_file_name(file_name):
+    # We split on '\' as well as '/' to support unix and windows-style paths
+    return re.split(r'[\\/]', file_name.rstrip('/'))
+
+
+class Pattern:
+    """A glob pattern, compiled to a regular expression over '/'-separated file names.
+    Matching takes time linear in the length of the file name, independently of the number of
+    '*' and '**' in the pattern.
+    """
+
+    def __init__(self, pattern):
+        pattern_components = _split_pattern(pattern)
+        self.pattern = pattern
+        self._regex = re.compile(_translate(pattern_components), flags=re.DOTALL)
+        self._component_regexes = [
+            None if c == '**' else re.compile(_translate_component(c), flags=re.DOTALL)
+            for c in pattern_components
+        ]
+
+    def match(self, file_name):
+        """Match the pattern against a file name.
+        :param file_name: The file name to match against. The path separator in file names is the platform separator
+        :return: True if the pattern matches, False otherwise
+        """
+        return self._regex.fullmatch('/'.join(_split_file_name(file_name))) is not None
+
+    def match_prefix(self, dir_name):
+        """Check whether the pattern can match any file name below a directory.
+        This allows a directory walk to skip subtrees in which the pattern can never match.
+        :param dir_name: The directory name to check. The path separator in file names is the platform separator
+        :return: True if some file name below the directory may match the pattern, False otherwise
+        """
+        dir_name_components = _split_file_name(dir_name)
+        for i, dir_name_component in enumerate(dir_name_components):
+            if i >= len(self._component_regexes):
+                return False
+            if self._component_regexes[i] is None:
+                return True
+            if self._component_regexes[i].fullmatch(dir_name_component) is None:
+                return False
+        return len(self._component_regexes) > len(dir_name_components)
+
+
+@functools.lru_cache(maxsize=256)
+def compile(pattern):
+    """Compile a glob pattern for repeated matching. Compiled patterns are cached.
+    See match() for the pattern syntax.
+    :param pattern: The pattern to compile. The path separator in patterns is always '/'.
+    :return: A Pattern object
+    """
+    return Pattern(pattern)
 
 
 def match(pattern, file_name):
@@ -72,14 +136,14 @@ def match(pattern, file_name):
     :param file_name: The file name to match against. The path separator in file names is the platform separator
     :return: True if the pattern matches, False otherwise
     """
-    if _double_star_after_invalid_regex.search(pattern) is not None or _double_star_first_before_invalid_regex.search(
-            pattern) is not None or _double_star_middle_before_invalid_regex.search(pattern) is not None:
-        raise ValueError('** in {} not alone between path separators'.format(pattern))
-    pattern = pattern.rstrip('/')
-    file_name = file_name.rstrip('/')
-    while '**/**' in pattern:
-        pattern = pattern.replace('**/**', '**')
-    pattern_components = pattern.split('/')
-    # We split on '\' as well as '/' to support unix and windows-style paths
-    file_name_components = re.split(r'[\\/]', file_name)
-    return _match_components(pattern_components, file_name_components)
+    return compile(pattern).match(file_name)
+
+
+def match_prefix(pattern, dir_name):
+    """Check whether a glob pattern can match any file name below a directory.
+    This allows a directory walk to skip subtrees in which the pattern can never match.
+    :param pattern: The pattern to match. The path separator in patterns is always '/'.
+    :param dir_name: The directory name to check. The path separator in file names is the platform separator
+    :return: True if some file name below the directory may match the pattern, False otherwise
+    """
+    return compile(pattern).match_prefix(dir_name)
@@ -1,22 +1,40 @@
 import textwrap
 import json
 import pprint
-import queue
+import collections
 import re
 import hashlib
 from os.path import isfile, join, relpath, islink, \
                     isdir, exists, basename, abspath, \
-                    dirname, expanduser, splitext
+                    dirname, expanduser, splitext, \
+                    realpath, normpath, lexists
 import os
 import sys
 import shutil
 import yaml
 import threading
+import selectors
+import socket
+import contextlib
+import io
+import codecs
+import asyncio
+import functools
+import tempfile
+import base64
+import errno
+import mmap
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+import time
 from semver import VersionInfo
 import subprocess
 from subprocess import CalledProcessError
 import globber
-from distutils import dir_util
+import cliver
+from concurrent.futures import ThreadPoolExecutor
 
 
 LANGUAGES = [
@@ -48,13 +66,248 @@ def isemptydir(directory, ignoredotfiles=False):
   )
 
 
-def clear_dir(dirpath):
-  for n in os.listdir(dirpath):
-    f = join(dirpath, n)
-    if isfile(f):
-      os.unlink(f)
-    elif isdir(f):
-      shutil.rmtree(f)
+SWAP_NEW_INFIX = '.tailor-new-'
+SWAP_OLD_INFIX = '.tailor-old-'
+
+
+def swap_sibling(dirpath, infix):
+  # a fresh directory next to dirpath, i.e. on the same file system,
+  # such that it can be renamed to dirpath
+  dirpath = realpath(dirpath)
+  return tempfile.mkdtemp(
+    prefix='.' + basename(dirpath) + infix,
+    dir=dirname(dirpath),
+  )
+
+
+def remove_tree_later(dirpath):
+  # Remove dirpath in a detached process, which outlives tailor, so
+  # that tailor does not have to wait for it. If that process cannot
+  # be started (or is killed), the next remove_swap_leftovers() of
+  # the swapped directory cleans up.
+  try:
+    subprocess.Popen(
+      [
+        sys.executable, '-c',
+        'import shutil, sys; shutil.rmtree(sys.argv[1], ignore_errors=True)',
+        dirpath,
+      ],
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL,
+      start_new_session=True,
+    )
+  except OSError as e:
+    warning(f'Unable to remove "{dirpath}" ({e}), it will be removed by the next run.')
+
+
+def remove_swap_leftovers(dirpath):
+  # remove what interrupted swaps of dirpath left behind
+  dirpath = realpath(dirpath)
+  parent = dirname(dirpath)
+  for n in os.listdir(parent):
+    for infix in (SWAP_NEW_INFIX, SWAP_OLD_INFIX):
+      if n.startswith('.' + basename(dirpath) + infix):
+        remove_tree_later(join(parent, n))
+
+
+def swap_dir(newdir, dirpath):
+  # replace dirpath with newdir (both on the same file system) by
+  # renaming, returning the old tree which the caller should remove
+  dirpath = realpath(dirpath)
+  olddir = join(swap_sibling(dirpath, SWAP_OLD_INFIX), 'tree')
+  os.rename(dirpath, olddir)
+  try:
+    os.rename(newdir, dirpath)
+  except:
+    os.rename(olddir, dirpath)
+    raise
+  return dirname(olddir)
+
+
+# ioctl(2) request to share a file's extents with another file
+# (reflink), e.g. on btrfs or XFS
+FICLONE = 0x40049409
+COPY_BUFSIZE = 1024 * 1024
+COPY_WORKERS = 8
+# errors which mean that a strategy does not work for a pair of file
+# systems, as opposed to a failure to copy a particular file
+UNSUPPORTED_ERRNOS = {
+  errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+  errno.EOPNOTSUPP, errno.EPERM, errno.EBADF, errno.EMLINK,
+}
+
+
+class TreeCopier:
+  # Copies directory trees using the cheapest strategy that works:
+  # renaming (if the source may be moved), hardlinks (opt-in, only
+  # for sources which are never written to, like the package cache),
+  # reflinks, copy_file_range(2) and finally a plain copy. Files are
+  # copied in parallel. Keeps per-strategy statistics.
+
+  def __init__(self, hardlink=False, workers=COPY_WORKERS, skip_identical=False):
+    self.hardlink = hardlink
+    # leave destination files alone which already have the right content
+    self.skip_identical = skip_identical
+    self.workers = workers
+    self.lock = threading.Lock()
+    # strategy => [count, bytes, seconds]
+    self.stats = {}
+    # (strategy, source device, destination device) which failed
+    self.unsupported = set()
+
+  def count(self, strategy, nbytes, start):
+    with self.lock:
+      s = self.stats.setdefault(strategy, [0, 0, 0.0])
+      s[0] += 1
+      s[1] += nbytes
+      s[2] += time.monotonic() - start
+
+  def supported(self, strategy, devs):
+    return (strategy,) + devs not in self.unsupported
+
+  def unsupported_by(self, strategy, devs, e):
+    if e.errno not in UNSUPPORTED_ERRNOS:
+      raise e
+    with self.lock:
+      self.unsupported.add((strategy,) + devs)
+
+  def copy_file(self, src, dst):
+    start = time.monotonic()
+    st = os.stat(src)
+    devs = (st.st_dev, os.stat(dirname(dst)).st_dev)
+    if self.skip_identical and same_content(src, st, dst):
+      self.count('unchanged', st.st_size, start)
+      return
+    # never write through an existing file, it may be a hardlink
+    if lexists(dst):
+      os.unlink(dst)
+
+    if self.hardlink and self.supported('hardlink', devs):
+      try:
+        os.link(src, dst)
+        self.count('hardlink', st.st_size, start)
+        return
+      except OSError as e:
+        self.unsupported_by('hardlink', devs, e)
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+      strategy = self.copy_data(fsrc.fileno(), fdst.fileno(), st.st_size, devs)
+      if strategy == 'copy':
+        shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+    shutil.copystat(src, dst)
+    self.count(strategy, st.st_size, start)
+
+  def copy_data(self, sfd, dfd, size, devs):
+    if fcntl and self.supported('reflink', devs):
+      try:
+        fcntl.ioctl(dfd, FICLONE, sfd)
+        return 'reflink'
+      except OSError as e:
+        self.unsupported_by('reflink', devs, e)
+
+    if hasattr(os, 'copy_file_range') and self.supported('copy_file_range', devs):
+      try:
+        while os.copy_file_range(sfd, dfd, max(size, COPY_BUFSIZE)) > 0:
+          pass
+        return 'copy_file_range'
+      except OSError as e:
+        self.unsupported_by('copy_file_range', devs, e)
+        # start over, in case some data was copied
+        os.lseek(sfd, 0, os.SEEK_SET)
+        os.lseek(dfd, 0, os.SEEK_SET)
+        os.ftruncate(dfd, 0)
+
+    return 'copy'
+
+  def copytree(self, src, dst, move=False, dirs_exist_ok=False):
+    if move and not exists(dst):
+      start = time.monotonic()
+      try:
+        os.rename(src, dst)
+        self.count('rename', 0, start)
+        return dst
+      except OSError as e:
+        if e.errno != errno.EXDEV:
+          raise
+
+    files = []
+    dirs = []
+    for root, dirnames, filenames in os.walk(src):
+      droot = dst if root == src else join(dst, relpath(root, src))
+      os.makedirs(droot, exist_ok=dirs_exist_ok or root != src)
+      dirs.append((root, droot))
+      for n in filenames + [d for d in dirnames if islink(join(root, d))]:
+        s, d = join(root, n), join(droot, n)
+        if islink(s):
+          if lexists(d) and dirs_exist_ok:
+            os.unlink(d)
+          os.symlink(os.readlink(s), d)
+        else:
+          files.append((s, d))
+    parallel_map(lambda sd: self.copy_file(*sd), files, self.workers)
+    for s, d in dirs:
+      shutil.copystat(s, d)
+    if move:
+      shutil.rmtree(src)
+    return dst
+
+  def report(self):
+    parts = []
+    for strategy, (n, nbytes, seconds) in sorted(self.stats.items()):
+      if strategy == 'rename':
+        parts.append(f'{strategy}: {seconds:.2f}s')
+      else:
+        parts.append(
+          f'{strategy}: {n} file{"" if n == 1 else "s"}, ' +
+          f'{nbytes / 1024**2:.1f} MiB, {seconds:.2f}s'
+        )
+    return ', '.join(parts)
+
+
+def copy_tree(src, dst, move=False, hardlink=False, dirs_exist_ok=False, verbose=False):
+  copier = TreeCopier(hardlink)
+  copier.copytree(src, dst, move=move, dirs_exist_ok=dirs_exist_ok)
+  if verbose:
+    info(f'Copied "{src}" to "{dst}" ({copier.report()}).')
+  return dst
+
+
+def sync_tree(src, dst):
+  # copy src into dst, skipping the files which are already up to date;
+  # returns the numbers of copied and skipped files
+  copier = TreeCopier(skip_identical=True)
+  copier.copytree(src, dst, dirs_exist_ok=True)
+  skipped = copier.stats.pop('unchanged', [0])[0]
+  return sum(n for n, _, _ in copier.stats.values()), skipped
+
+
+def same_content(path, st, other):
+  # whether the file other exists and has the same content as path
+  try:
+    if os.stat(other).st_size != st.st_size:
+      return False
+    with open(path, 'rb') as f1, open(other, 'rb') as f2:
+      while True:
+        b1 = f1.read(COPY_BUFSIZE)
+        if b1 != f2.read(COPY_BUFSIZE):
+          return False
+        if not b1:
+          return True
+  except OSError:
+    return False
+
+
+def stage_pack(basepath, stagepath, hardlink=False):
+  # A working copy of basepath. Where possible, it shares the files'
+  # data with basepath via reflinks. With hardlink=True, its files are
+  # hardlinks to those of basepath instead, whose links tailor breaks
+  # before modifying them (other tools don't).
+  copy_tree(basepath, stagepath, hardlink=hardlink, verbose=True)
+  if hardlink:
+    # "codeql pack install" (re)writes these in place
+    for f in (qlpackyml(stagepath), codeql_pack_lock_yml(stagepath)):
+      break_link(f)
 
 
 def scriptdir():
@@ -75,7 +328,7 @@ def tailor_template(
   outname,
 ):
 
-  shutil.copytree(
+  copy_tree(
     join(commondir(), 'scripts'),
     outdir,
     dirs_exist_ok=True,
@@ -84,7 +337,7 @@ def tailor_template(
   testpack_template = join(templatedir(), lang, 'unit-tests')
   testpack = join(outdir, 'unit-tests')
 
-  shutil.copytree(
+  copy_tree(
     testpack_template,
     testpack
   )
@@ -173,6 +426,15 @@ def compare_version(v1, v2):
   return VersionInfo.parse(v1).compare(VersionInfo.parse(v2))
 
 
+def parallel_map(fn, items, workers=None):
+  # like map(), but on a thread pool; results keep the order of items
+  items = list(items)
+  if len(items) < 2:
+    return [fn(i) for i in items]
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(fn, items))
+
+
 def error(msg):
   sys.exit('ERROR: ' + msg)
 
@@ -190,11 +452,66 @@ def file2str(filepath):
     return f.read()
 
 
+def break_link(filepath):
+  # give a hardlinked file (e.g. in a pack created by "tailor stage")
+  # its own copy of the data, such that writing to it leaves the other
+  # links untouched
+  try:
+    if os.lstat(filepath).st_nlink < 2:
+      return
+  except FileNotFoundError:
+    return
+  fd, tmpfile = tempfile.mkstemp(dir=dirname(abspath(filepath)), prefix='.tmp-')
+  os.close(fd)
+  try:
+    shutil.copy2(filepath, tmpfile)
+    os.replace(tmpfile, filepath)
+  except:
+    os.unlink(tmpfile)
+    raise
+
+
+def unlink_shared(filepath):
+  # before rewriting a hardlinked file entirely, just remove this link,
+  # there is no point in copying the data break_link() would preserve
+  try:
+    if os.lstat(filepath).st_nlink > 1:
+      os.unlink(filepath)
+  except FileNotFoundError:
+    pass
+
+
 def str2file(filepath, string):
+  unlink_shared(filepath)
   with open(filepath, 'w') as f:
     f.write(string)
 
 
+def cachedir():
+  return os.environ.get('TAILOR_CACHE_DIR') or join(
+    os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'),
+    'gh-tailor'
+  )
+
+
+def load_json(filepath, default=None):
+  try:
+    with open(filepath, 'r') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return default
+
+
+def store_json(filepath, data):
+  # write to a temporary file and rename, so that concurrent
+  # tailor processes never observe a partially written file
+  os.makedirs(dirname(filepath), exist_ok=True)
+  tmpfile = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(tmpfile, 'w') as f:
+    json.dump(data, f)
+  os.replace(tmpfile, filepath)
+
+
 def codeql_pack_lock_yml(ppath):
   return join(ppath, 'codeql-pack.lock.yml')
 
@@ -248,6 +565,7 @@ def get_pack_lock_info(ppath, default=None):
 
 
 def set_pack_lock_info(ppath, info):
+  unlink_shared(codeql_pack_lock_yml(ppath))
   with open(codeql_pack_lock_yml(ppath), 'w') as f:
     yaml.dump(info, f)
 
@@ -268,78 +586,272 @@ def parse_version(vstr):
   )
 
 
-def rglob(dirpath, pattern, hidden=False):
-  for f in listdir(dirpath, hidden=hidden):
+def rglob(dirpath, pattern, hidden=False, packs=False):
+  compiled = globber.compile(pattern)
+  for f in listdir(dirpath, hidden=hidden, pattern=pattern, packs=packs):
     file2match = relpath(f, dirpath)
-    if globber.match(pattern, file2match):
+    if compiled.match(file2match):
       yield f
 
 
-def listdir(dirpath, hidden=False):
-  dirs = queue.Queue()
-  dirs.put(dirpath)
-  while not dirs.empty():
-    d = dirs.get()
-    for f in sorted(os.listdir(d)):
-      if (hidden == False and f[0] == '.'):
+def listdir(dirpath, hidden=False, pattern=None, packs=False):
+  # Breadth-first, sorted walk. Subtrees below which the pattern cannot
+  # match are not entered and, with packs=True, neither are directories
+  # which contain a qlpack.yml.
+  compiled = globber.compile(pattern) if pattern is not None else None
+  dirs = collections.deque([(dirpath, '')])
+  while dirs:
+    d, reld = dirs.popleft()
+    with os.scandir(d) as it:
+      entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+      if (hidden == False and e.name[0] == '.'):
         continue
-      absf = join(d, f)
-      if isdir(absf):
-        dirs.put(absf)
+      absf = join(d, e.name)
+      if e.is_dir():
+        relf = join(reld, e.name)
+        if not (
+          (compiled and not compiled.match_prefix(relf)) or
+          (packs and is_pack(absf))
+        ):
+          dirs.append((absf, relf))
       yield absf
 
 
-def hash_dir(dirpath):
-  def hash_file(path, h):
-    if islink(path):
-      h.update(b'link')
+HASH_BUFSIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+def hash_file(path):
+  h = hashlib.sha1()
+  if basename(path) == 'qlpack.yml':
+    with open(path, 'r') as f:
+      y = yaml.safe_load(f) or {}
+      y.get('buildMetadata', {}) \
+       .pop('creationTime', None)
+      y.pop('version', None)
       h.update(
-        os.readlink(path).encode('utf-8')
+        pprint.pformat(
+          y,
+          sort_dicts=True,
+          indent=1
+        ).encode('utf-8')
       )
-    elif isfile(path):
-      h.update(b'file')
-
-      if basename(path) == 'qlpack.yml':
-        with open(path, 'r') as f:
-          y = yaml.safe_load(f) or {}
-          y.get('buildMetadata', {}) \
-           .pop('creationTime', None)
-          y.pop('version', None)
-          h.update(
-            pprint.pformat(
-              y,
-              sort_dicts=True,
-              indent=1
-            ).encode('utf-8')
-          )
+  else:
+    with open(path, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if size >= HASH_MMAP_THRESHOLD:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+          h.update(m)
       else:
-        with open(path, 'rb') as f:
-          while True:
-            bs = f.read(4096)
-            if bs == b'':
-              break
-            h.update(bs)
-    elif isdir(path):
-      h.update(b'directory')
-    else:
-      error(f'Unexpected file type for "{path}"!')
-
-  h = hashlib.sha1()
-  for f in listdir(dirpath):
-    hash_file(f, h)
-    h.update(relpath(f, dirpath).encode('utf-8'))
+        buf = bytearray(min(size, HASH_BUFSIZE) or 1)
+        view = memoryview(buf)
+        while True:
+          n = f.readinto(buf)
+          if not n:
+            break
+          h.update(view[:n])
   return h.hexdigest()
 
 
-def hash_pack(ppath):
-  return hash_dir(ppath)
+class HashCache:
+  # Persistent digests of individual files, keyed by path and only
+  # valid as long as the file's size, mtime and inode are unchanged.
+
+  # files modified this recently might still change without their
+  # mtime changing (coarse timestamp granularity), so they are not cached
+  RACY_NS = 2 * 10**9
+
+  def __init__(self, cachefile=None):
+    self.cachefile = cachefile or join(cachedir(), 'hashes.json')
+    self.entries = load_json(self.cachefile, {}) or {}
+    self.modified = False
+    self.start = time.time_ns()
+
+  def stamp(self, st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+  def lookup(self, path, st):
+    entry = self.entries.get(abspath(path))
+    if entry and entry[:3] == self.stamp(st):
+      return entry[3]
+    return None
+
+  def store(self, path, st, digest):
+    key = abspath(path)
+    if st.st_mtime_ns < self.start - HashCache.RACY_NS:
+      self.entries[key] = self.stamp(st) + [digest]
+      self.modified = True
+    elif self.entries.pop(key, None):
+      self.modified = True
+
+  def prune(self, dirpath, seen):
+    # forget the files below dirpath which were not seen by a walk of
+    # it; hidden subtrees (e.g. a pack's .codeql) are not walked by
+    # hash_tree() but hashed on their own, so they are left alone
+    prefix = join(abspath(dirpath), '')
+    for key in list(self.entries.keys()):
+      if (
+        key.startswith(prefix) and key not in seen and
+        not any(c[0] == '.' for c in key[len(prefix):].split(os.sep))
+      ):
+        del self.entries[key]
+        self.modified = True
+
+  def save(self):
+    if self.modified:
+      store_json(self.cachefile, self.entries)
+      self.modified = False
+
+
+def hash_tree(dirpath, cache=None):
+  # Merkle tree of a directory, ignoring hidden files: Returns a pair
+  # (digest, entries), where entries maps names to subtrees for
+  # directories and to (digest, None) for files and links. A
+  # directory's digest covers the names, types and digests of its
+  # entries, so two trees can be compared level by level.
+  # Files missing from the cache are hashed concurrently.
+  cache = cache or HashCache()
+  digests = {}
+  pending = []
+
+  def walk(path):
+    entries = []
+    with os.scandir(path) as it:
+      for e in sorted(it, key=lambda e: e.name):
+        if e.name[0] == '.':
+          continue
+        if e.is_symlink():
+          entries.append((b'link', e.name, hashstr(os.readlink(e.path))))
+        elif e.is_file():
+          st = e.stat()
+          d = cache.lookup(e.path, st)
+          if d is None:
+            pending.append((e.path, st))
+          else:
+            digests[e.path] = d
+          entries.append((b'file', e.name, e.path))
+        elif e.is_dir():
+          entries.append((b'directory', e.name, walk(e.path)))
+        else:
+          error(f'Unexpected file type for "{e.path}"!')
+    return entries
+
+  def fold(entries):
+    result = {}
+    h = hashlib.sha1()
+    for kind, name, sub in entries:
+      if kind == b'directory':
+        sub = fold(sub)
+      elif kind == b'file':
+        sub = (digests[sub], None)
+      else:
+        sub = (sub, None)
+      result[name] = sub
+      h.update(kind + b'\0' + name.encode('utf-8') + b'\0' + sub[0].encode('utf-8') + b'\n')
+    return h.hexdigest(), result
+
+  entries = walk(dirpath)
+  for (path, st), d in zip(
+    pending,
+    parallel_map(hash_file, [path for path, _ in pending])
+  ):
+    digests[path] = d
+    cache.store(path, st, d)
+
+  tree = fold(entries)
+  cache.prune(dirpath, set(abspath(p) for p in digests))
+  cache.save()
+  return tree
+
+
+def hash_dir(dirpath):
+  return hash_tree(dirpath)[0]
+
+
+def file_digest(path, st, cache):
+  d = cache.lookup(path, st)
+  if d is None:
+    d = hash_file(path)
+    cache.store(path, st, d)
+  return d
+
+
+def same_file_content(path1, st1, path2, st2, cache):
+  # the digests are cached, so comparing unchanged files again later
+  # does not read them
+  return file_digest(path1, st1, cache) == file_digest(path2, st2, cache)
+
+
+def diff_dirs(dirpath1, dirpath2):
+  # Returns the relative path of the first difference between two
+  # directories or None if they are equal in the sense of hash_dir().
+  # All names, types and sizes are compared before any file content is
+  # read, and content is compared file by file by (cached) digest,
+  # stopping at the first difference.
+  cache = HashCache()
+  contents = []
+
+  def kind(e):
+    if e.is_symlink():
+      return 'link'
+    elif e.is_file():
+      return 'file'
+    elif e.is_dir():
+      return 'directory'
+    error(f'Unexpected file type for "{e.path}"!')
+
+  def entries(path):
+    with os.scandir(path) as it:
+      return {e.name: e for e in it if e.name[0] != '.'}
+
+  def cmp_structure(rel):
+    es1 = entries(join(dirpath1, rel))
+    es2 = entries(join(dirpath2, rel))
+    for name in sorted(set(es1.keys()) | set(es2.keys())):
+      relf = join(rel, name)
+      if not (name in es1 and name in es2):
+        return relf
+      e1, e2 = es1[name], es2[name]
+      k = kind(e1)
+      if k != kind(e2):
+        return relf
+      if k == 'link':
+        if os.readlink(e1.path) != os.readlink(e2.path):
+          return relf
+      elif k == 'file':
+        st1, st2 = e1.stat(), e2.stat()
+        if name != 'qlpack.yml' and st1.st_size != st2.st_size:
+          return relf
+        contents.append((relf, e1.path, st1, e2.path, st2))
+      else:
+        d = cmp_structure(relf)
+        if d:
+          return d
+    return None
+
+  d = cmp_structure('')
+  if d:
+    return d
+  try:
+    for relf, path1, st1, path2, st2 in contents:
+      if not same_file_content(path1, st1, path2, st2, cache):
+        return relf
+    return None
+  finally:
+    cache.save()
+
+
+def diff_packs(ppath1, ppath2):
+  return diff_dirs(ppath1, ppath2)
 
 
 def cmp_packs(ppath1, ppath2):
-  return hash_pack(ppath1) == hash_pack(ppath2)
+  return diff_packs(ppath1, ppath2) is None
 
 
 def set_pack_info(ppath, info):
+  unlink_shared(qlpackyml(ppath))
   with open(qlpackyml(ppath), 'w') as f:
     yaml.dump(info, f)
 
@@ -387,6 +899,7 @@ def pack_add_dep(ppath, name, version):
   set_pack_value(ppath, 'dependencies', deps)
 
 
+@functools.lru_cache(maxsize=None)
 def search_manifest_dir(path):
   current = abspath(path)
   while True:
@@ -404,7 +917,8 @@ def print_to_stdout(cmd, stream):
     line = stream.readline()
     if line == '':
       break
-    print(line, end='', flush=True)
+    sys.stdout.write(line)
+  sys.stdout.flush()
   stream.close()
 
 
@@ -425,6 +939,36 @@ class Recorder:
     stream.close()
 
 
+class LinePump:
+  # Decodes a subprocess' binary output incrementally and hands all
+  # complete lines received so far to a consumer, as a text stream.
+  # Consumers are thus called once per chunk rather than once per
+  # line or once per process.
+
+  def __init__(self, cmd, consumer):
+    self.cmd = cmd
+    self.consumer = consumer
+    self.decoder = io.IncrementalNewlineDecoder(
+      codecs.getincrementaldecoder('utf-8')(errors='replace'),
+      translate=True,
+    )
+    self.pending = ''
+
+  def feed(self, data):
+    self.pending += self.decoder.decode(data)
+    idx = self.pending.rfind('\n')
+    if idx >= 0:
+      lines = self.pending[:idx + 1]
+      self.pending = self.pending[idx + 1:]
+      self.consumer(self.cmd, io.StringIO(lines))
+
+  def close(self):
+    self.pending += self.decoder.decode(b'', final=True)
+    if self.pending:
+      self.consumer(self.cmd, io.StringIO(self.pending))
+      self.pending = ''
+
+
 class Executable:
   def __init__(self, executable):
     self.executable = executable
@@ -448,8 +992,6 @@ class Executable:
 
     with subprocess.Popen(
       command,
-      bufsize = 1,
-      universal_newlines=True,
       stdout=outpipe,
       stderr=errpipe,
       stdin=inpipe,
@@ -458,40 +1000,287 @@ class Executable:
     ) as proc:
 
       commandstr = ' '.join(command)
-      tout = threading.Thread(target=outconsumer, args=(commandstr, proc.stdout))
-      tout.start()
-      terr = None
+      pumps = {proc.stdout: LinePump(commandstr, outconsumer)}
       if not combine_std_out_err:
-        terr = threading.Thread(target=errconsumer, args=(commandstr, proc.stderr))
-        terr.start()
-      tin = threading.Thread(target=inprovider, args=(commandstr, proc.stdin))
-      tin.start()
+        pumps[proc.stderr] = LinePump(commandstr, errconsumer)
+
+      tin = None
+      if inprovider is close_stdin:
+        proc.stdin.close()
+      else:
+        tin = threading.Thread(target=inprovider, args=(commandstr, proc.stdin))
+        tin.start()
+
+      if os.name == 'posix':
+        pump_selector(pumps)
+      else:
+        # selectors cannot wait for pipes on Windows
+        pump_threads(pumps)
 
       ret = proc.wait()
-      tout.join()
-      tin.join()
-      if terr:
-        terr.join()
+      if tin:
+        tin.join()
       if ret != 0:
         raise CalledProcessError(cmd=commandstr, returncode=ret)
 
+  async def run_async(
+    self,
+    *args,
+    outconsumer=print_to_stdout,
+    errconsumer=print_to_stdout,
+    combine_std_out_err=True,
+    cwd='.',
+    env=None,
+  ):
+    # An awaitable variant of __call__(), for running several
+    # processes concurrently on one event loop.
+    command = [self.executable] + list(args)
+    commandstr = ' '.join(command)
+    proc = await asyncio.create_subprocess_exec(
+      *command,
+      stdout=asyncio.subprocess.PIPE,
+      stderr=asyncio.subprocess.STDOUT if combine_std_out_err else asyncio.subprocess.PIPE,
+      stdin=asyncio.subprocess.DEVNULL,
+      cwd=cwd,
+      env=env,
+    )
+
+    async def pump(stream, consumer):
+      p = LinePump(commandstr, consumer)
+      while True:
+        data = await stream.read(65536)
+        if not data:
+          break
+        p.feed(data)
+      p.close()
+
+    pumps = [pump(proc.stdout, outconsumer)]
+    if not combine_std_out_err:
+      pumps.append(pump(proc.stderr, errconsumer))
+    await asyncio.gather(*pumps)
+    ret = await proc.wait()
+    if ret != 0:
+      raise CalledProcessError(cmd=commandstr, returncode=ret)
+
+
+def pump_selector(pumps):
+  with selectors.DefaultSelector() as sel:
+    for stream, pump in pumps.items():
+      sel.register(stream, selectors.EVENT_READ, pump)
+    while sel.get_map():
+      for key, _ in sel.select():
+        data = os.read(key.fd, 65536)
+        if data:
+          key.data.feed(data)
+        else:
+          sel.unregister(key.fileobj)
+          key.data.close()
+
+
+def pump_threads(pumps):
+  def run(stream, pump):
+    while True:
+      data = stream.read1(65536)
+      if not data:
+        break
+      pump.feed(data)
+    pump.close()
+
+  threads = [
+    threading.Thread(target=run, args=(stream, pump))
+    for stream, pump in pumps.items()
+  ]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+
+class CliServer:
+  # A long-running "codeql execute cli-server" process, which saves
+  # the JVM startup for every command. The protocol is simple: A
+  # command's arguments are sent as a JSON array, terminated by a NUL
+  # byte, and the server answers with the command's standard output,
+  # again terminated by a NUL byte. There is no exit code; a command
+  # which fails terminates the server (as the VS Code extension's client
+  # assumes, too), so the server has to be restarted afterwards.
+
+  def __init__(self, command, env=None):
+    # The process is only started by the first command, so that a
+    # tailor command which does not need the CLI at all does not pay
+    # for a JVM. For the same reason, env may be a callable returning
+    # the environment, which is called when it is first needed.
+    self.command = command
+    self.env = env
+    self.lock = threading.Lock()
+    self.proc = None
+
+  def environment(self):
+    if callable(self.env):
+      self.env = self.env()
+    return self.env
+
+  def start(self):
+    self.proc = subprocess.Popen(
+      self.command,
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      env=self.environment(),
+    )
+
+  def alive(self):
+    # a server which was never started has not died either
+    return self.proc is None or self.proc.poll() is None
+
+  def run(
+    self,
+    args,
+    outconsumer=print_to_stdout,
+    errconsumer=print_to_stdout,
+    combine_std_out_err=True,
+  ):
+    # Raises CalledProcessError if the command failed (which includes
+    # the server terminating while running it) and EOFError if the
+    # server was gone before the command could be sent.
+    commandstr = ' '.join(self.command + ['--'] + list(args))
+    out = bytearray()
+    err = bytearray()
+
+    try:
+      self.proc.stdin.write(json.dumps(list(args)).encode('utf-8') + b'\0')
+      self.proc.stdin.flush()
+    except OSError as e:
+      raise EOFError(f'"{commandstr}" could not be sent ({e})!')
+
+    exited = False
+    with selectors.DefaultSelector() as sel:
+      sel.register(self.proc.stdout, selectors.EVENT_READ, out)
+      sel.register(self.proc.stderr, selectors.EVENT_READ, err)
+      done = False
+      while not done:
+        for key, _ in sel.select():
+          data = os.read(key.fd, 65536)
+          if not data:
+            # the server terminated, collect the rest of its output
+            exited = done = True
+            break
+          if key.data is out and b'\0' in data:
+            data = data[:data.index(b'\0')]
+            done = True
+          key.data.extend(data)
+
+      if exited:
+        for f, buf in ((self.proc.stdout, out), (self.proc.stderr, err)):
+          while True:
+            data = os.read(f.fileno(), 65536)
+            if not data:
+              break
+            buf.extend(data)
+      else:
+        # the server writes a command's stderr before the terminating
+        # NUL on stdout, so whatever is left is already in the pipe
+        sel.unregister(self.proc.stdout)
+        while sel.select(timeout=0):
+          data = os.read(self.proc.stderr.fileno(), 65536)
+          if not data:
+            break
+          err.extend(data)
+
+    if exited:
+      returncode = self.proc.wait()
+
+    def stream(bs):
+      return io.StringIO(bs.decode('utf-8', errors='replace').replace('\r\n', '\n'))
+
+    if combine_std_out_err:
+      outconsumer(commandstr, stream(out + err))
+    else:
+      outconsumer(commandstr, stream(out))
+      errconsumer(commandstr, stream(err))
+
+    if exited:
+      raise CalledProcessError(cmd=commandstr, returncode=returncode or 1)
+    if b'A fatal error occurred' in err:
+      raise CalledProcessError(cmd=commandstr, returncode=1)
+
+  def close(self):
+    if self.proc is None:
+      return
+    try:
+      self.proc.stdin.close()
+      self.proc.wait(timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+      self.proc.kill()
+      self.proc.wait()
+    finally:
+      self.proc.stdout.close()
+      self.proc.stderr.close()
+
 
 def exec_from_path_env(execname):
   e = shutil.which(execname)
   return Executable(e) if e else None
 
 
+def file_identity(path):
+  path = realpath(path)
+  st = os.stat(path)
+  return [path, st.st_mtime_ns, st.st_size]
+
+
+def dist_cache_file():
+  return join(cachedir(), 'codeql-dists.json')
+
+
+def cached_detection(key, identity, detect, valid=lambda value: True):
+  # Memoise the result of detect() on disk, for as long as the given
+  # identity (e.g. an executable's path, mtime and size) does not change.
+  if identity is not None:
+    entry = (load_json(dist_cache_file(), {}) or {}).get(key)
+    if entry and entry['identity'] == identity and valid(entry['value']):
+      return entry['value']
+  value = detect()
+  if identity is not None and value is not None:
+    cache = load_json(dist_cache_file(), {}) or {}
+    cache[key] = {'identity': identity, 'value': value}
+    store_json(dist_cache_file(), cache)
+  return value
+
+
+def remember_codeql_version(distdir, version):
+  codeql = join(distdir, codeql_exec_name())
+  if isfile(codeql):
+    cached_detection(
+      'version:' + realpath(codeql),
+      file_identity(codeql),
+      lambda: version,
+    )
+
+
+def detect_dist(executable, *args):
+  rec = Recorder()
+  executable(
+    *args,
+    'version',
+    '--format', 'json',
+    combine_std_out_err=False,
+    outconsumer=rec
+  )
+  j = json.loads(''.join(rec.lines))
+  remember_codeql_version(j['unpackedLocation'], j['version'])
+  return j['unpackedLocation']
+
+
 def codeql_dist_from_path_env():
   codeql = exec_from_path_env(codeql_exec_name())
   if codeql:
-    rec = Recorder()
-    codeql(
-      'version',
-      '--format', 'json',
-      combine_std_out_err=False,
-      outconsumer=rec
+    return cached_detection(
+      'path:' + realpath(codeql.executable),
+      file_identity(codeql.executable),
+      lambda: detect_dist(codeql),
+      valid=is_dist,
     )
-    return json.loads(''.join(rec.lines))['unpackedLocation']
   return None
 
 
@@ -519,34 +1308,68 @@ def gh_token():
   return None
 
 
-def env_with_token():
-  env = os.environ.copy()
-  token = env.get('GITHUB_TOKEN')
+def github_token():
+  token = os.environ.get('GITHUB_TOKEN')
   if not token:
     info('Environment variable "GITHUB_TOKEN" is not set. Attempting to use token of the "gh" cli...')
     token = gh_token()
+  if not token:
+    warning('Unable to get a valid "GITHUB_TOKEN", please set it manually if needed.')
+  return token
+
+
+def env_for_token(token):
+  env = os.environ.copy()
   if token:
     env['GITHUB_TOKEN'] = token
-  else:
-    warning('Unable to get a valid "GITHUB_TOKEN", please set it manually if needed.')
   return env
 
 
+def gh_codeql_identity(gh):
+  # "gh codeql" selects its CodeQL version via files in its extension
+  # directory or a ".codeql-version" file in the working directory
+  # (or one of its parents). Without an extension directory to look
+  # at, the detection is not cached.
+  extdir = join(
+    os.environ.get('XDG_DATA_HOME') or expanduser('~/.local/share'),
+    'gh', 'extensions', 'gh-codeql'
+  )
+  if not isdir(extdir):
+    return None
+  with os.scandir(extdir) as it:
+    extfiles = sorted([e.name, e.stat().st_mtime_ns] for e in it)
+  localversions = []
+  current = abspath('.')
+  while True:
+    f = join(current, '.codeql-version')
+    if isfile(f):
+      localversions.append(file_identity(f))
+    parent = dirname(current)
+    if parent == current:
+      break
+    current = parent
+  return [
+    file_identity(gh.executable),
+    os.stat(extdir).st_mtime_ns,
+    extfiles,
+    localversions,
+  ]
+
+
 def codeql_dist_from_gh_codeql():
   gh = exec_from_path_env('gh')
   if gh:
-    try:
-      rec = Recorder()
-      gh(
-        'codeql',
-        'version',
-        '--format', 'json',
-        combine_std_out_err=False,
-        outconsumer=rec
-      )
-      return json.loads(''.join(rec.lines))['unpackedLocation']
-    except CalledProcessError:
-      pass
+    def detect():
+      try:
+        return detect_dist(gh, 'codeql')
+      except CalledProcessError:
+        return None
+    return cached_detection(
+      'gh-codeql:' + abspath('.'),
+      gh_codeql_identity(gh),
+      detect,
+      valid=is_dist,
+    )
   return None
 
 
@@ -554,24 +1377,621 @@ def codeql_exec_name():
   return 'codeql' + ("" if os.name == 'posix' else '.exe')
 
 
+def pack_cache_dir():
+  return expanduser('~/.codeql/packages')
+
+
+class PackCacheIndex:
+  # An on-disk index of the packs in the CodeQL package cache
+  # (~/.codeql/packages/<scope>/<name>/<version>). A directory is only
+  # re-listed if its mtime changed since the last refresh and a pack's
+  # qlpack.yml is only re-parsed if its own mtime changed, so a refresh
+  # costs about one stat() per directory above the pack level.
+
+  def __init__(self, root=None, indexfile=None):
+    self.root = root or pack_cache_dir()
+    self.indexfile = indexfile or join(
+      cachedir(),
+      'packcache-%s.json' % hashstr(abspath(self.root)),
+    )
+    self.dirs = {}
+    self.byname = {}
+
+  def refresh(self):
+    old = (load_json(self.indexfile, {}) or {}).get('dirs', {})
+    new = {}
+
+    def scan(rel):
+      path = join(self.root, rel)
+      try:
+        mtime = os.stat(path).st_mtime_ns
+      except OSError:
+        return
+
+      entry = old.get(rel)
+      if entry and entry['mtime'] == mtime:
+        if 'pack' in entry:
+          try:
+            qlmtime = os.stat(qlpackyml(path)).st_mtime_ns
+          except OSError:
+            qlmtime = None
+          if qlmtime == entry['pack']['mtime']:
+            new[rel] = entry
+            return
+        else:
+          new[rel] = entry
+          for d in entry['subdirs']:
+            scan(join(rel, d))
+          return
+
+      subdirs = []
+      isqlpack = False
+      with os.scandir(path) as it:
+        for e in it:
+          if e.name == 'qlpack.yml' and e.is_file():
+            isqlpack = True
+          elif e.name[0] != '.' and e.is_dir():
+            subdirs.append(e.name)
+
+      if isqlpack:
+        new[rel] = {'mtime': mtime, 'pack': self.read_pack(path)}
+      else:
+        new[rel] = {'mtime': mtime, 'subdirs': sorted(subdirs)}
+        for d in new[rel]['subdirs']:
+          scan(join(rel, d))
+
+    if isdir(self.root):
+      scan('')
+
+    if new != old:
+      store_json(self.indexfile, {'root': self.root, 'dirs': new})
+
+    byname = {}
+    for rel, entry in sorted(new.items()):
+      p = entry.get('pack')
+      if p and p['name']:
+        byname.setdefault(p['name'], []).append(
+          (p['version'], p['cliVersion'], join(self.root, rel))
+        )
+    # replaced as a whole, since other threads may look up packs while
+    # the index is refreshed
+    self.dirs = new
+    self.byname = byname
+    return self
+
+  def read_pack(self, ppath):
+    mtime = os.stat(qlpackyml(ppath)).st_mtime_ns
+    try:
+      pi = get_pack_info(ppath) or {}
+    except yaml.YAMLError:
+      pi = {}
+    return {
+      'mtime': mtime,
+      'name': pi.get('name', None),
+      'version': str(pi.get('version', '0.0.0')),
+      'cliVersion': (pi.get('buildMetadata') or {}).get('cliVersion', None),
+    }
+
+  def paths(self):
+    for versions in self.byname.values():
+      for _, _, p in versions:
+        yield p
+
+  def lookup(self, packname):
+    return self.byname.get(packname, [])
+
+
+class QuerySelector:
+  # A condition on a query's metadata: "key=value" (equal), "key!=value"
+  # (missing or different) or "key~token" (one of the whitespace
+  # separated words of the value, e.g. "tags~security").
+
+  def __init__(self, selector):
+    m = re.match(r'^([^=!~\s]+)\s*(!=|=|~)\s*(.*)$', selector)
+    if not m:
+      raise ValueError(f'Invalid selector "{selector}"!')
+    self.key, self.op, self.value = m.group(1), m.group(2), m.group(3).strip()
+
+  def matches(self, metadata):
+    v = metadata.get(self.key, None)
+    if self.op == '=':
+      return v == self.value
+    if self.op == '!=':
+      return v != self.value
+    return v is not None and self.value in v.split()
+
+
+class QueryIndex:
+  # An on-disk index of the metadata of a pack's queries, keyed by the
+  # query's path relative to the pack. A query is only re-read if its
+  # size, mtime or inode changed since the last refresh.
+
+  def __init__(self, ppath, indexfile=None):
+    self.ppath = ppath
+    self.indexfile = indexfile or join(
+      cachedir(),
+      'queries-%s.json' % hashstr(abspath(ppath)),
+    )
+    self.queries = {}
+
+  def refresh(self):
+    old = (load_json(self.indexfile, {}) or {}).get('queries', {})
+    new = {}
+    start = time.time_ns()
+    for f in listdir(self.ppath, packs=True):
+      if splitext(f)[1] != '.ql':
+        continue
+      rel = relpath(f, self.ppath)
+      st = os.stat(f)
+      stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+      entry = old.get(rel)
+      if entry and entry['stamp'] == stamp:
+        new[rel] = entry
+        continue
+      metadata, _, _ = read_ql_header(f)
+      new[rel] = {
+        # see HashCache.RACY_NS
+        'stamp': stamp if st.st_mtime_ns < start - HashCache.RACY_NS else None,
+        'hash': hash_file(f),
+        'metadata': dict(metadata),
+      }
+
+    if new != old:
+      store_json(self.indexfile, {'pack': abspath(self.ppath), 'queries': new})
+    self.queries = new
+    return self
+
+  def select(self, selectors):
+    return [
+      join(self.ppath, rel)
+      for rel, entry in sorted(self.queries.items())
+      if all(s.matches(entry['metadata']) for s in selectors)
+    ]
+
+
+def select_queries(ppath, selectors):
+  return QueryIndex(ppath).refresh().select(
+    [QuerySelector(s) for s in selectors]
+  )
+
+
+GHCR_URL = 'https://ghcr.io'
+
+
+# seconds to wait for each response when listing a pack's versions,
+# before falling back to probing versions one by one
+REGISTRY_TIMEOUT = 10
+
+
+def registry_versions(pname, token=None):
+  # All versions of a pack in the default container registry, in
+  # ascending order, or None if they cannot be listed (e.g. without
+  # network access or for packs hosted elsewhere).
+  auth = {
+    'Authorization': 'Basic ' + base64.b64encode(f'x:{token}'.encode('utf-8')).decode('ascii')
+  } if token else {}
+  try:
+    _, _, body = cliver.request(
+      f'{GHCR_URL}/token?scope=repository:{pname}:pull&service=ghcr.io',
+      headers=auth,
+      timeout=REGISTRY_TIMEOUT,
+    )
+    headers = {'Authorization': 'Bearer ' + json.loads(body)['token']}
+    url = f'{GHCR_URL}/v2/{pname}/tags/list?n=1000'
+    tags = []
+    while url:
+      _, respheaders, body = cliver.request(
+        url,
+        headers=headers,
+        timeout=REGISTRY_TIMEOUT,
+      )
+      tags.extend(json.loads(body).get('tags') or [])
+      url = cliver.parse_link_header(respheaders.get('link')).get('next', None)
+      if url and url.startswith('/'):
+        url = GHCR_URL + url
+  except (socket.timeout, OSError, ValueError, KeyError) as e:
+    info(f'Unable to list the versions of {pname} in the registry ({e or "timed out"}).')
+    return None
+  return sorted(
+    filter(VersionInfo.isvalid, tags),
+    key=VersionInfo.parse
+  )
+
+
+# seconds for which a pack version missing from the registry is
+# assumed to still be missing
+NOT_FOUND_TTL = 10 * 60
+
+
+def registry_id():
+  qlconfig = expanduser('~/.codeql/qlconfig.yml')
+  if isfile(qlconfig):
+    return 'qlconfig:' + hashstr(file2str(qlconfig))
+  return GHCR_URL
+
+
+def not_found_file():
+  return join(cachedir(), 'not-found.json')
+
+
+def is_known_not_found(packname, matchstr):
+  t = (load_json(not_found_file(), {}) or {}) \
+        .get(registry_id(), {}) \
+        .get(packname, {}) \
+        .get(matchstr, None)
+  return t is not None and 0 <= time.time() - t < NOT_FOUND_TTL
+
+
+def record_not_found(packname, matchstr):
+  now = time.time()
+  cache = load_json(not_found_file(), {}) or {}
+  for registry in list(cache.keys()):
+    for pname in list(cache[registry].keys()):
+      cache[registry][pname] = {
+        m: t for m, t in cache[registry][pname].items()
+        if now - t < NOT_FOUND_TTL
+      }
+      if not cache[registry][pname]:
+        del cache[registry][pname]
+  cache.setdefault(registry_id(), {}) \
+       .setdefault(packname, {})[matchstr] = now
+  store_json(not_found_file(), cache)
+
+
+def forget_not_found(packname):
+  cache = load_json(not_found_file(), {}) or {}
+  if cache.get(registry_id(), {}).pop(packname, None) is not None:
+    store_json(not_found_file(), cache)
+
+
+def pack_cli_versions_file():
+  return join(cachedir(), 'pack-cli-versions.json')
+
+
+def known_pack_cli_versions(pname):
+  # the version of the CLI which built each published version of a pack;
+  # published packs never change, so these never expire
+  return (load_json(pack_cli_versions_file(), {}) or {}).get(pname, {})
+
+
+def record_pack_cli_version(pname, version, cli_version):
+  known = load_json(pack_cli_versions_file(), {}) or {}
+  if known.get(pname, {}).get(version, '') != cli_version:
+    known.setdefault(pname, {})[version] = cli_version
+    store_json(pack_cli_versions_file(), known)
+
+
+def dir_size(dirpath):
+  size = 0
+  for root, _, files in os.walk(dirpath):
+    for f in files:
+      size += os.lstat(join(root, f)).st_size
+  return size
+
+
+def pack_dependency_names(ppath):
+  pi = get_pack_info(ppath) or {}
+  names = list((pi.get('dependencies') or {}).keys())
+  libdeps = pi.get('libraryPathDependencies') or []
+  names.extend([libdeps] if type(libdeps) == str else libdeps)
+  return names
+
+
+def local_dependencies(ppath, roots):
+  # the packs below roots which ppath (transitively) depends on
+  bynames = {}
+  for root in roots:
+    if not isdir(root):
+      continue
+    for d in [root] + list(listdir(root, packs=True)):
+      if isdir(d) and is_pack(d):
+        try:
+          name = get_pack_name(d)
+        except (yaml.YAMLError, OSError):
+          continue
+        bynames.setdefault(name, set()).add(d)
+
+  result = set()
+  todo = pack_dependency_names(ppath)
+  while todo:
+    for dep in bynames.pop(todo.pop(), ()):
+      if realpath(dep) != realpath(ppath):
+        result.add(dep)
+        todo.extend(pack_dependency_names(dep))
+  return sorted(result)
+
+
+class BuildCache:
+  # Compiled packs, keyed by the pack's sources (including its
+  # dependencies in .codeql and its lock file) and the CLI version.
+  # Once the cache grows beyond maxsize bytes, the least recently
+  # used entries are evicted.
+
+  # seconds after which an unfinished entry is considered abandoned
+  TMP_MAX_AGE = 3600
+
+  def __init__(self, root=None, maxsize=2 * 1024**3):
+    self.root = root or join(cachedir(), 'builds')
+    self.maxsize = maxsize
+
+  def key(self, ppath, cli_version, roots=()):
+    # roots are the directories of the search path and additional
+    # packs, from which dependencies may be resolved, too
+    h = hashlib.sha1()
+    h.update(hash_dir(ppath).encode('utf-8'))
+    # hash_dir() ignores hidden files and the pack's version
+    if isdir(join(ppath, '.codeql')):
+      h.update(hash_dir(join(ppath, '.codeql')).encode('utf-8'))
+    for dep in local_dependencies(ppath, roots):
+      h.update(abspath(dep).encode('utf-8'))
+      h.update(get_pack_version(dep).encode('utf-8'))
+      h.update(hash_dir(dep).encode('utf-8'))
+    if isfile(codeql_pack_lock_yml(ppath)):
+      with open(codeql_pack_lock_yml(ppath), 'rb') as f:
+        h.update(f.read())
+    h.update(get_pack_version(ppath).encode('utf-8'))
+    h.update(cli_version.encode('utf-8'))
+    return h.hexdigest()
+
+  def entry(self, key):
+    return join(self.root, key)
+
+  def get(self, key):
+    e = self.entry(key)
+    if not isfile(join(e, 'size')):
+      return None
+    try:
+      os.utime(join(e, 'size'))
+    except OSError:
+      return None
+    return join(e, 'pack')
+
+  def put(self, key, packdir):
+    os.makedirs(self.root, exist_ok=True)
+    size = dir_size(packdir)
+    if size > self.maxsize:
+      return
+    tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+    try:
+      copy_tree(packdir, join(tmp, 'pack'))
+      str2file(join(tmp, 'size'), str(size))
+      os.rename(tmp, self.entry(key))
+    except OSError:
+      # another tailor process may have stored the same build
+      shutil.rmtree(tmp, ignore_errors=True)
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for n in os.listdir(self.root):
+      if n.startswith('.tmp-'):
+        # left behind by an interrupted put(), unless it is still
+        # being written to
+        try:
+          if os.stat(join(self.root, n)).st_mtime < time.time() - BuildCache.TMP_MAX_AGE:
+            shutil.rmtree(join(self.root, n), ignore_errors=True)
+        except OSError:
+          pass
+        continue
+      sizefile = join(self.root, n, 'size')
+      try:
+        entries.append((os.stat(sizefile).st_mtime, int(file2str(sizefile)), n))
+      except (OSError, ValueError):
+        pass
+    total = sum(size for _, size, _ in entries)
+    for _, size, n in sorted(entries):
+      if total <= self.maxsize:
+        break
+      info(f'Evicting "{n}" from the build cache.')
+      shutil.rmtree(self.entry(n), ignore_errors=True)
+      total -= size
+
+
+class Session:
+  # Values which do not change during a tailor command, but which are
+  # expensive or noisy to compute (e.g. the GitHub token, which may
+  # require running "gh auth status"). Each is computed on first use
+  # and then shared by all calls, also across threads.
+
+  def __init__(self, codeql):
+    self.codeql = codeql
+    self.lock = threading.RLock()
+    self.values = {}
+
+  def memo(self, key, compute):
+    with self.lock:
+      if key not in self.values:
+        self.values[key] = compute()
+      return self.values[key]
+
+  def token(self):
+    return self.memo('token', github_token)
+
+  def env(self):
+    return self.memo('env', lambda: env_for_token(self.token()))
+
+  def cli_version(self):
+    return self.memo(
+      'cli_version',
+      lambda: cached_detection(
+        'version:' + realpath(self.codeql.executable),
+        file_identity(self.codeql.executable),
+        self.codeql.detect_version,
+      )
+    )
+
+  def search_path_args(self):
+    def compute():
+      args = []
+      if self.codeql.additional_packs:
+        args.append('--additional-packs')
+        args.append(self.codeql.additional_packs)
+      if self.codeql.search_path:
+        args.append('--search-path')
+        args.append(self.codeql.search_path)
+      return args
+    return self.memo('search_path_args', compute)
+
+  def pack_cache_dir(self):
+    return self.memo('pack_cache_dir', pack_cache_dir)
+
+
+# number of dependencies resolved concurrently by make_lockfile()
+RESOLVE_WORKERS = 4
+
+
 class CodeQL(Executable):
 
-  def __init__(self, distdir, additional_packs=None, search_path=None):
+  def __init__(
+    self, distdir,
+    additional_packs=None,
+    search_path=None,
+    use_cli_server=True,
+    use_not_found_cache=True,
+    prefer_cache=False,
+    offline=False,
+  ):
     Executable.__init__(self, join(distdir, codeql_exec_name()))
     self.distdir = distdir
     self.additional_packs = additional_packs
     self.search_path = search_path
+    self.packcache = None
+    self.use_cli_server = use_cli_server and os.name == 'posix'
+    self.server = None
+    self.server_lock = threading.Lock()
+    self.session = Session(self)
+    self.resolved = {}
+    self.registry_versions = {}
+    self.use_not_found_cache = use_not_found_cache
+    # answer pack lookups from the package cache and the search path
+    # first and, when offline, never consult the registry
+    self.prefer_cache = prefer_cache
+    self.offline = offline
+    self.resolved_locks = {}
+    self.resolved_lock = threading.Lock()
+
+
+  def __call__(
+    self,
+    *args,
+    outconsumer=print_to_stdout,
+    errconsumer=print_to_stdout,
+    combine_std_out_err=True,
+    inprovider=close_stdin,
+    cwd='.',
+    env=None,
+  ):
+    # a server which died between two commands is restarted and the
+    # command sent again; if that fails, too, the server is given up
+    for attempt in range(2):
+      server = self.acquire_server(inprovider, cwd, env)
+      if not server:
+        break
+      try:
+        return server.run(
+          args,
+          outconsumer=outconsumer,
+          errconsumer=errconsumer,
+          combine_std_out_err=combine_std_out_err,
+        )
+      except EOFError as e:
+        if attempt > 0:
+          warning(f'The CodeQL cli server failed ({e}), falling back to separate processes.')
+          with self.server_lock:
+            if self.server is server:
+              self.server = None
+      finally:
+        server.lock.release()
+
+    return Executable.__call__(
+      self,
+      *args,
+      outconsumer=outconsumer,
+      errconsumer=errconsumer,
+      combine_std_out_err=combine_std_out_err,
+      inprovider=inprovider,
+      cwd=cwd,
+      env=env,
+    )
+
+
+  def acquire_server(self, inprovider, cwd, env):
+    # the (locked) cli server to run a command on, if it can run there
+    server = self.server
+    if (
+      not server or
+      inprovider is not close_stdin or cwd != '.' or
+      not (env is None or env == server.environment())
+    ):
+      return None
+    if not server.alive():
+      server = self.restart_server(server)
+    if not server or not server.lock.acquire(blocking=False):
+      return None
+    if server.proc is None:
+      try:
+        server.start()
+      except OSError as e:
+        warning(f'Unable to start the CodeQL cli server ({e}), using separate processes.')
+        with self.server_lock:
+          if self.server is server:
+            self.server = None
+        server.lock.release()
+        return None
+    return server
+
+
+  def restart_server(self, old):
+    # failing commands terminate the cli server, replace it by a new one
+    with self.server_lock:
+      if self.server is not old:
+        return self.server
+      if not old.lock.acquire(blocking=False):
+        # still draining the output of the command which failed
+        return None
+      try:
+        old.close()
+      finally:
+        old.lock.release()
+      # started by the next command, see acquire_server()
+      self.server = CliServer(old.command, old.env)
+      return self.server
+
+
+  @contextlib.contextmanager
+  def cli_server(self, env=None):
+    # Run the CodeQL commands issued within this context in a single
+    # cli server process. Commands with a different environment or
+    # working directory and commands issued while the server is busy
+    # still get a process of their own. The server is only started
+    # by the first command and env may be a callable, see CliServer.
+    if not self.use_cli_server or self.server:
+      yield self
+      return
+    self.server = CliServer(
+      [self.executable, 'execute', 'cli-server'],
+      env=env,
+    )
+    try:
+      yield self
+    finally:
+      with self.server_lock:
+        server, self.server = self.server, None
+      if server:
+        server.close()
+
+
+  def search_roots(self):
+    # the directories in which the CLI looks for packs, besides the
+    # package cache and the distribution
+    return [
+      r for sp in (self.additional_packs, self.search_path) if sp
+      for r in sp.split(os.pathsep) if r
+    ]
 
 
   def make_search_path_args(self):
-    args = []
-    if self.additional_packs:
-      args.append('--additional-packs')
-      args.append(self.additional_packs)
-    if self.search_path:
-      args.append('--search-path')
-      args.append(self.search_path)
-    return args
+    return list(self.session.search_path_args())
 
 
   def make_lockfile(
@@ -591,15 +2011,27 @@ class CodeQL(Executable):
     pideps = pi.get('dependencies') or {}
     pi['dependencies'] = pideps
 
+    unresolved = [(d, v) for d, v in pideps.items() if d not in lideps]
+    resolved = dict(
+      zip(
+        [d for d, _ in unresolved],
+        parallel_map(
+          lambda dv: self.resolve_pack_version(
+            dv[0],
+            dv[1],
+            match_cli=match_cli
+          ),
+          unresolved,
+          workers=RESOLVE_WORKERS,
+        )
+      )
+    )
+
     for d, v in pideps.items():
       if d in lideps:
         pideps[d] = lideps[d]['version']
       else:
-        resolvedv = self.resolve_pack_version(
-          d,
-          v,
-          match_cli=match_cli
-        )
+        resolvedv = resolved[d]
         if resolvedv is None:
           error(f'Could not resolve {d}@{v}!')
         pideps[d] = resolvedv
@@ -627,7 +2059,8 @@ class CodeQL(Executable):
         packname,
         packversion,
         use_search_path=False,
-        match_cli=False
+        match_cli=False,
+        prefer_cache=False,
       ):
         warning(f'Package {packname}@{packversion} already exists!')
         if fail:
@@ -641,17 +2074,18 @@ class CodeQL(Executable):
         packname,
         '*',
         use_search_path=False,
-        match_cli=False
+        match_cli=False,
+        prefer_cache=False,
       )
 
       if latestpeer:
-        identical = cmp_packs(ppath, latestpeer)
-        if identical:
+        difference = diff_packs(ppath, latestpeer)
+        if difference is None:
           warning('This pack and its latest version in the registry are identical!')
           if fail:
             return 2
         else:
-          info('This pack and its latest version in the registry differ!')
+          info(f'This pack and its latest version in the registry differ (e.g. in "{difference}")!')
 
         newv = set_pack_version(
           ppath,
@@ -670,7 +2104,8 @@ class CodeQL(Executable):
         packname,
         packversion,
         use_search_path=False,
-        match_cli=False
+        match_cli=False,
+        prefer_cache=False,
       ):
         info(f'Package {packname}@{packversion} already exists.')
         return self.autoversion(ppath, 'new', fail)
@@ -692,27 +2127,24 @@ class CodeQL(Executable):
     )
 
 
-  def create_inplace(self, ppath, tmppath):
-    self(
-      'pack', 'create',
-      '--threads', '0',
-      '--output', tmppath,
-      '-vv',
-      ppath
-    )
-
+  def compile_pack(self, ppath, tmppath, build_cache=None):
+    key = build_cache.key(
+      ppath,
+      self.get_version(),
+      self.search_roots(),
+    ) if build_cache else None
     tmppack = join(
       tmppath,
       get_pack_name(ppath),
       get_pack_version(ppath),
     )
 
-    clear_dir(ppath)
-    dir_util.copy_tree(tmppack, ppath)
-    shutil.rmtree(tmppath)
-
+    cached = build_cache.get(key) if key else None
+    if cached:
+      info(f'Pack is unchanged since an earlier build, restoring it from "{cached}".')
+      copy_tree(cached, tmppack, verbose=True)
+      return tmppack
 
-  def create(self, ppath, outdir, tmppath):
     self(
       'pack', 'create',
       '--threads', '0',
@@ -721,13 +2153,116 @@ class CodeQL(Executable):
       ppath
     )
 
-    tmppack = join(
-      tmppath,
-      get_pack_name(ppath),
-      get_pack_version(ppath),
+    if key:
+      build_cache.put(key, tmppack)
+    return tmppack
+
+
+  def incremental_plan(self, ppath, basepath):
+    # If ppath was derived from the compiled pack basepath, only
+    # the queries which changed or (transitively) import a changed
+    # library need to be compiled again, the others can keep the
+    # precompiled .qlx files of basepath. Returns these queries or
+    # None, if the whole pack must be compiled.
+    def fallback(reason):
+      info(f'Compiling the whole pack, since {reason}.')
+      return None
+
+    if get_pack_cli_version(basepath, None) != self.get_version():
+      return fallback('the base pack was compiled by a different CLI version')
+    if not any(splitext(f)[1] == '.qlx' for f in listdir(basepath, packs=True)):
+      return fallback('the base pack contains no precompiled queries')
+    depdirs = [join(p, '.codeql') for p in (ppath, basepath)]
+    if isdir(depdirs[0]) != isdir(depdirs[1]) or (
+      isdir(depdirs[0]) and diff_dirs(*depdirs) is not None
+    ):
+      return fallback('its dependencies differ from those of the base pack')
+    locks = [
+      file2str(f) if isfile(f) else None
+      for f in (codeql_pack_lock_yml(p) for p in (ppath, basepath))
+    ]
+    if locks[0] != locks[1]:
+      return fallback('its lock file differs from that of the base pack')
+
+    graph = ql_import_graph(ppath)
+    if set(ql_import_graph(basepath).keys()) - set(graph.keys()):
+      return fallback('QL files of the base pack were removed')
+
+    cache = HashCache()
+    changed = []
+    for f in graph.keys():
+      sf, bf = join(ppath, f), join(basepath, f)
+      if not isfile(bf):
+        changed.append(f)
+        continue
+      sst, bst = os.stat(sf), os.stat(bf)
+      if os.path.samestat(sst, bst):
+        # a write through the link would have changed both
+        return fallback(f'"{f}" is a hardlink to the base pack\'s file')
+      if not same_file_content(sf, sst, bf, bst, cache):
+        changed.append(f)
+    cache.save()
+
+    return sorted(
+      f for f in affected_ql_files(graph, changed)
+      if splitext(f)[1] == '.ql'
     )
 
-    shutil.copytree(tmppack, outdir)
+
+  def compile_queries(self, ppath, queries, batchsize=200):
+    if not queries:
+      info('No queries are affected by the customizations, nothing to compile.')
+      return
+    info(f'Compiling {len(queries)} affected quer{"y" if len(queries) == 1 else "ies"}...')
+    for q in queries:
+      qlx = splitext(join(ppath, q))[0] + '.qlx'
+      if isfile(qlx):
+        os.unlink(qlx)
+    # the session's search path, plus the pack's installed dependencies
+    libraries = join(ppath, '.codeql', 'libraries')
+    search_path = self.make_search_path_args()
+    if '--additional-packs' in search_path:
+      i = search_path.index('--additional-packs') + 1
+      search_path[i] = searchpath_append(search_path[i], libraries)
+    else:
+      search_path = ['--additional-packs', libraries] + search_path
+    for i in range(0, len(queries), batchsize):
+      self(
+        'query', 'compile',
+        '--precompile',
+        '--threads', '0',
+        *search_path,
+        *[join(ppath, q) for q in queries[i:i + batchsize]]
+      )
+
+
+  def create_inplace(self, ppath, build_cache=None, base=None):
+    queries = self.incremental_plan(ppath, base) if base else None
+    if queries is not None:
+      self.compile_queries(ppath, queries)
+      return
+
+    remove_swap_leftovers(ppath)
+    # compile next to the pack, so that the result can be swapped in by
+    # renaming instead of copying it
+    tmppath = swap_sibling(ppath, SWAP_NEW_INFIX)
+    try:
+      tmppack = self.compile_pack(ppath, tmppath, build_cache)
+      remove_tree_later(swap_dir(tmppack, ppath))
+    finally:
+      remove_tree_later(tmppath)
+
+
+  def create(self, ppath, outdir, tmppath, build_cache=None, base=None):
+    queries = self.incremental_plan(ppath, base) if base else None
+    if queries is not None:
+      copy_tree(ppath, outdir, verbose=True)
+      self.compile_queries(outdir, queries)
+      return
+
+    tmppack = self.compile_pack(ppath, tmppath, build_cache)
+
+    copy_tree(tmppack, outdir, move=True, verbose=True)
     shutil.rmtree(tmppath)
 
 
@@ -748,28 +2283,49 @@ class CodeQL(Executable):
           yield v
 
     if use_pack_cache:
-      packcache = expanduser('~/.codeql/packages')
-      for p in rglob(packcache, '**'):
-        if is_pack(p):
-          yield p
+      yield from self.pack_cache_index().paths()
+
 
+  def pack_cache_index(self):
+    if self.packcache is None:
+      self.packcache = PackCacheIndex(self.session.pack_cache_dir())
+    return self.packcache.refresh()
+
+
+  def get_pack(
+    self, packname, matchstr,
+    use_search_path=True, use_pack_cache=True,
+    max_cli_version=None
+  ):
+    candidates = []
+    if use_search_path:
+      for p in self.list_packs(use_search_path=True, use_pack_cache=False):
+        pi = get_pack_info(p)
+        if pi.get('name', None) == packname:
+          candidates.append((
+            str(pi.get('version', '0.0.0')),
+            (pi.get('buildMetadata') or {}).get('cliVersion', None),
+            p
+          ))
+    if use_pack_cache:
+      candidates.extend(self.pack_cache_index().lookup(packname))
 
-  def get_pack(self, packname, matchstr, use_search_path=True, use_pack_cache=True):
     latestp = None
     latestv = '0.0.0'
-    for p in self.list_packs(
-      use_search_path=use_search_path,
-      use_pack_cache=use_pack_cache,
-    ):
-      if get_pack_name(p) == packname:
-        v = get_pack_version(p)
-        if match_version(v, matchstr) and compare_version(v, latestv) >= 0:
-          latestv = v
-          latestp = p
+    for v, cliv, p in candidates:
+      if max_cli_version and cliv and compare_version(cliv, max_cli_version) > 0:
+        continue
+      if match_version(v, matchstr) and compare_version(v, latestv) >= 0:
+        latestv = v
+        latestp = p
     return latestp
 
 
   def get_version(self):
+    return self.session.cli_version()
+
+
+  def detect_version(self):
     rec = Recorder()
     self(
       'version',
@@ -785,9 +2341,27 @@ class CodeQL(Executable):
     pname,
     matchstr,
     match_cli=True,
-    use_search_path=True
+    use_search_path=True,
+    prefer_cache=None,
   ):
     cli_version = self.get_version()
+    if prefer_cache is None:
+      prefer_cache = self.prefer_cache
+
+    if prefer_cache or self.offline:
+      p = self.get_pack(
+        pname,
+        matchstr,
+        use_search_path=use_search_path,
+        use_pack_cache=True,
+        max_cli_version=cli_version if match_cli else None,
+      )
+      if p:
+        info(f'Using {pname}@{get_pack_version(p)} from "{p}".')
+        return p
+      if self.offline:
+        info(f'{pname}@{matchstr} is not available locally and the registry is not consulted in offline mode.')
+        return None
 
     info(f'Downloading {pname}@{matchstr}...')
     p = self.download_pack_impl(
@@ -795,8 +2369,83 @@ class CodeQL(Executable):
       matchstr,
       use_search_path=use_search_path
     )
+    if not(p and match_cli):
+      return p
+    pv = get_pack_version(p)
+    if not match_version(pv, matchstr):
+      return None
+    record_pack_cli_version(pname, pv, get_pack_cli_version(p, None))
+    if compare_version(
+      get_pack_cli_version(p, cli_version),
+      cli_version
+    ) <= 0:
+      return p
+
+    versions = self.list_registry_versions(pname)
+    if versions is None:
+      return self.download_pack_stepwise(
+        pname,
+        matchstr,
+        p,
+        cli_version,
+        use_search_path=use_search_path
+      )
+
+    # Packs are built by ever newer CLIs, so the newest compatible
+    # version can be found by binary search. The CLI version of every
+    # probed pack is recorded, so that later searches need fewer (or
+    # no) downloads.
+    candidates = [
+      v for v in versions
+      if match_version(v, matchstr) and compare_version(v, pv) < 0
+    ]
+    info(f'Latest pack was incompatible with this CLI, searching {len(candidates)} older version(s) of {pname}...')
+    best = None
+    lo, hi = 0, len(candidates) - 1
+    while lo <= hi:
+      mid = (lo + hi) // 2
+      compatible = self.is_cli_compatible(
+        pname,
+        candidates[mid],
+        cli_version,
+        use_search_path=use_search_path
+      )
+      if compatible is None:
+        # a version which cannot be downloaded (anymore) says nothing
+        # about its neighbours, search without it
+        del candidates[mid]
+        hi -= 1
+      elif compatible:
+        best = candidates[mid]
+        lo = mid + 1
+      else:
+        hi = mid - 1
+
+    if best is None:
+      return None
+    info(f'Downloading {pname}@{best}, the newest version compatible with this CLI...')
+    return self.get_pack(
+      pname,
+      best,
+      use_search_path=False,
+      use_pack_cache=True
+    ) or self.download_pack_impl(
+      pname,
+      best,
+      use_search_path=use_search_path
+    )
+
+
+  def download_pack_stepwise(
+    self,
+    pname,
+    matchstr,
+    p,
+    cli_version,
+    use_search_path=True
+  ):
     while True:
-      if not(p and match_cli):
+      if not p:
         return p
       pv = get_pack_version(p)
       if not match_version(pv, matchstr):
@@ -816,21 +2465,71 @@ class CodeQL(Executable):
       )
 
 
+  def list_registry_versions(self, pname):
+    # only GHCR's tags can be listed; with another registry configured
+    # (qlconfig.yml), "codeql pack download" would probe that one
+    if registry_id() != GHCR_URL:
+      return None
+    if pname not in self.registry_versions:
+      self.registry_versions[pname] = registry_versions(
+        pname,
+        None if self.offline else self.session.token()
+      )
+    return self.registry_versions[pname]
+
+
+  def pack_cli_versions(self, pname):
+    known = known_pack_cli_versions(pname)
+    for v, cliv, _ in self.pack_cache_index().lookup(pname):
+      known.setdefault(v, cliv)
+    return known
+
+
+  def is_cli_compatible(self, pname, version, cli_version, use_search_path=True):
+    # None if the version cannot be downloaded
+    known = self.pack_cli_versions(pname)
+    if version not in known:
+      info(f'Checking which CLI built {pname}@{version}...')
+      p = self.download_pack_impl(
+        pname,
+        version,
+        use_search_path=use_search_path
+      )
+      if p is None:
+        return None
+      known[version] = get_pack_cli_version(p, None)
+      record_pack_cli_version(pname, version, known[version])
+    return known[version] is None or \
+           compare_version(known[version], cli_version) <= 0
+
+
   def resolve_pack_version(
     self, pname, matchstr,
     default=None, match_cli=True,
     use_search_path=True
   ):
-    pack = self.download_pack(
-      pname,
-      matchstr,
-      match_cli=match_cli,
-      use_search_path=use_search_path
-    )
-    return get_pack_version(pack) if pack else default
+    # results are shared per (name, range), also between threads
+    key = (pname, matchstr, match_cli, use_search_path)
+    with self.resolved_lock:
+      keylock = self.resolved_locks.setdefault(key, threading.Lock())
+    with keylock:
+      if key not in self.resolved:
+        pack = self.download_pack(
+          pname,
+          matchstr,
+          match_cli=match_cli,
+          use_search_path=use_search_path
+        )
+        self.resolved[key] = get_pack_version(pack) if pack else None
+    v = self.resolved[key]
+    return default if v is None else v
 
 
   def download_pack_impl(self, packname, matchstr, use_search_path=True):
+    if self.use_not_found_cache and is_known_not_found(packname, matchstr):
+      info(f'{packname}@{matchstr} was not found in the registry recently, skipping download.')
+      return None
+
     not_found = set()
 
     def errgobbler(cmd, stream):
@@ -858,7 +2557,7 @@ class CodeQL(Executable):
         combine_std_out_err=False,
         errconsumer=errgobbler,
         outconsumer=rec,
-        env=env_with_token(),
+        env=self.session.env(),
       )
       j = json.loads(''.join(rec.lines))
       latestv = None
@@ -892,6 +2591,7 @@ class CodeQL(Executable):
 
     except CalledProcessError as e:
       if not_found:
+        record_not_found(packname, matchstr)
         return None
       else:
         raise
@@ -915,43 +2615,56 @@ def copy2dir(srcroot, srcpattern, dstroot, dstdirpattern, hidden=False):
         error(f'"{dstdir}" is not a directory!')
       dstpath = join(dstdir, basename(srcfile))
       if isfile(srcfile):
+        unlink_shared(dstpath)
         shutil.copyfile(srcfile, dstpath)
       else:
-        shutil.copytree(srcfile, dstpath, dirs_exist_ok=True)
+        copy_tree(srcfile, dstpath, dirs_exist_ok=True)
       executed = True
   return executed
 
 
 def delete_ql_meta(qlfile, key):
-  before, metadata, after = dissect_query(file2str(qlfile))
-  metadata = list(
-    filter(
-      lambda el: el[0] != key,
-      metadata
-    )
-  )
-  str2file(
-    qlfile,
-    assemble_query(before, metadata, after),
-  )
-  info(f'Deleted metadata key "{key}" in "{qlfile}".')
+  for m in edit_ql_meta(qlfile, delete=[key]):
+    info(m)
 
 
 def set_ql_meta(qlfile, key, value):
-  before, metadata, after = dissect_query(file2str(qlfile))
-  modified = False
-  for i, (k, v) in enumerate(metadata):
-    if k == key:
-      metadata[i] = (key, value)
-      modified = True
-      break
-  if not modified:
-    metadata.append((key, value))
-  str2file(
-    qlfile,
-    assemble_query(before, metadata, after),
-  )
-  info(f'Set metadata key "{key}" to value "{value}" in "{qlfile}".')
+  for m in edit_ql_meta(qlfile, meta=[(key, value)]):
+    info(m)
+
+
+def edit_ql_meta(qlfile, meta=(), delete=()):
+  # set the (key, value) pairs in meta, then delete the keys in delete;
+  # only the file's header is parsed and the file is written (if
+  # modified) only once. Returns the log messages.
+  metadata, header, offset = read_ql_header(qlfile)
+  messages = []
+  for key, value in meta:
+    for i, (k, v) in enumerate(metadata):
+      if k == key:
+        metadata[i] = (key, value)
+        break
+    else:
+      metadata.append((key, value))
+    messages.append(f'Set metadata key "{key}" to value "{value}" in "{qlfile}".')
+  for key in delete:
+    metadata = [el for el in metadata if el[0] != key]
+    messages.append(f'Deleted metadata key "{key}" in "{qlfile}".')
+  result = assemble_query('', metadata, '').encode('utf-8')
+  if result != header:
+    write_ql_header(qlfile, result, offset)
+  return messages
+
+
+def edit_ql_metas(qlfiles, meta=(), delete=(), workers=None):
+  # edit_ql_meta() for all files, on a thread pool, like ql_imports()
+  for messages in parallel_map(
+    lambda qlf: edit_ql_meta(qlf, meta, delete),
+    unique_paths(qlfiles),
+    workers=workers,
+  ):
+    for m in messages:
+      info(m)
 
 
 def assemble_query(before, metadata, after):
@@ -961,37 +2674,106 @@ def assemble_query(before, metadata, after):
     + after
 
 
-def dissect_query(qlstr):
-  # extract metadata section
-  m = re.match(
-    '^(.*?)(/\*\*(.*?)\*/)?(.*)$',
-    qlstr,
-    flags=re.DOTALL
-  )
-  if not m:   # there should ALWAYS be a match!
-    raise Exception('Internal Error')
-  before, metadata_section, after = m.group(1), m.group(3), m.group(4)
-  metadata_section = metadata_section or ''
+QL_DISSECT_REGEX = re.compile(r'^(.*?)(/\*\*(.*?)\*/)?(.*)$', flags=re.DOTALL)
+QL_META_KEY_REGEX = re.compile(r'^\s*\*?\s*@', flags=re.MULTILINE)
+QL_META_SEP_REGEX = re.compile(r'\s')
+QL_META_PREFIX_REGEX = re.compile(r'^\s*\*?\s*', flags=re.MULTILINE)
+QL_META_SPACE_REGEX = re.compile(r'\s+')
+QL_META_START = b'/**'
+QL_META_END = b'*/'
+QL_HEADER_CHUNK = 4096
 
-  lines = re.split(
-    '^\s*\*?\s*@',
-    metadata_section,
-    flags=re.MULTILINE,
-  )[1:]
 
+def parse_ql_metadata(metadata_section):
   result = []
-  for l in lines:
-    key, value = re.split('\s', l, maxsplit=1)
-    value = re.sub(
-      '^\s*\*?\s*',
-      '',
-      value,
-      flags=re.MULTILINE
-    )
-    value = re.sub('\s+', ' ', value).strip()
+  for l in QL_META_KEY_REGEX.split(metadata_section)[1:]:
+    key, value = QL_META_SEP_REGEX.split(l, maxsplit=1)
+    value = QL_META_PREFIX_REGEX.sub('', value)
+    value = QL_META_SPACE_REGEX.sub(' ', value).strip()
     result.append((key, value))
+  return result
 
-  return before, result, after
+
+def dissect_query(qlstr):
+  # extract metadata section
+  m = QL_DISSECT_REGEX.match(qlstr)
+  if not m:   # there should ALWAYS be a match!
+    raise Exception('Internal Error')
+  before, metadata_section, after = m.group(1), m.group(3), m.group(4)
+  return before, parse_ql_metadata(metadata_section or ''), after
+
+
+def read_ql_header(qlfile):
+  # Like dissect_query(), but only reads the file up to the end of its
+  # metadata section (which is only recognized at the very beginning
+  # of the file). Returns the metadata, the section's raw bytes and
+  # the offset of the rest of the file.
+  with open(qlfile, 'rb') as f:
+    buf = f.read(len(QL_META_START))
+    if buf != QL_META_START:
+      return [], b'', 0
+    start = len(QL_META_START)
+    while True:
+      end = buf.find(QL_META_END, start)
+      if end >= 0:
+        break
+      chunk = f.read(QL_HEADER_CHUNK)
+      if not chunk:
+        return [], b'', 0
+      start = max(len(QL_META_START), len(buf) - len(QL_META_END) + 1)
+      buf += chunk
+  header = buf[:end + len(QL_META_END)]
+  section = buf[len(QL_META_START):end].decode('utf-8')
+  section = section.replace('\r\n', '\n').replace('\r', '\n')
+  return parse_ql_metadata(section), header, len(header)
+
+
+def copy_file_rest(sfd, dfd, offset):
+  # append the contents of sfd from offset on to dfd, without passing
+  # the data through user space where possible
+  remaining = os.fstat(sfd).st_size - offset
+  if hasattr(os, 'copy_file_range'):
+    def transfer(offset, n):
+      return os.copy_file_range(sfd, dfd, n, offset_src=offset)
+  elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    # elsewhere (e.g. macOS), sendfile() only writes to sockets
+    def transfer(offset, n):
+      return os.sendfile(dfd, sfd, offset, n)
+  else:
+    transfer = None
+  try:
+    while transfer and remaining > 0:
+      n = transfer(offset, remaining)
+      if n == 0:
+        return
+      offset += n
+      remaining -= n
+  except OSError as e:
+    if e.errno not in UNSUPPORTED_ERRNOS:
+      raise
+  os.lseek(sfd, offset, os.SEEK_SET)
+  while remaining > 0:
+    data = os.read(sfd, min(remaining, COPY_BUFSIZE))
+    if not data:
+      return
+    remaining -= len(data)
+    while data:
+      data = data[os.write(dfd, data):]
+
+
+def write_ql_header(qlfile, header, offset):
+  # replace the first offset bytes of qlfile with header
+  fd, tmpfile = tempfile.mkstemp(dir=dirname(abspath(qlfile)), prefix='.tmp-')
+  try:
+    with os.fdopen(fd, 'wb') as out, open(qlfile, 'rb') as src:
+      out.write(header)
+      out.flush()
+      copy_file_rest(src.fileno(), out.fileno(), offset)
+    shutil.copymode(qlfile, tmpfile)
+    os.replace(tmpfile, qlfile)
+  except:
+    os.unlink(tmpfile)
+    raise
 
 
 def is_qlfile(path):
@@ -1002,15 +2784,136 @@ def is_qllfile(path):
   return isfile(path) and splitext(path)[1] == '.qll'
 
 
+QL_IMPORT_REGEX = re.compile(
+  r'^\s*(?:private\s+)?import\s+([A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)',
+  flags=re.MULTILINE,
+)
+
+
+QL_IMPORTED_REGEX = re.compile(
+  r'^\s*(?:private\s+)?import\s+([^\s/]+)(?:\s+as\s+(\w+))?',
+  flags=re.MULTILINE,
+)
+# string literals (kept) and comments (removed)
+QL_COMMENT_REGEX = re.compile(
+  r'("(?:[^"\\\n]|\\.)*")|/\*.*?\*/|//[^\n]*',
+  flags=re.DOTALL,
+)
+HIDDEN_IMPORT_PREFIX = 'hiddentailorimports'
+
+
+def strip_ql_comments(qlstr):
+  # comments are replaced by their newlines, to keep line starts intact
+  return QL_COMMENT_REGEX.sub(
+    lambda m: m.group(1) or '\n' * m.group(0).count('\n'),
+    qlstr,
+  )
+
+
+def ql_imported_modules(qlstr):
+  # the (module, visible) pairs imported by the given QL code; an
+  # import is visible if it has no alias
+  return set(
+    (module, not alias)
+    for module, alias in QL_IMPORTED_REGEX.findall(strip_ql_comments(qlstr))
+    if not alias or alias.startswith(HIDDEN_IMPORT_PREFIX)
+  )
+
+
+def ql_import_graph(ppath):
+  # maps each .ql and .qll file of a pack (relative to the pack) to
+  # the pack's library files it imports; imports from other packs
+  # are not tracked
+  files = [
+    relpath(f, ppath) for f in listdir(ppath, packs=True)
+    if is_qlfile(f) or is_qllfile(f)
+  ]
+  fileset = set(files)
+  graph = {}
+  for f in files:
+    deps = set()
+    for m in QL_IMPORT_REGEX.finditer(file2str(join(ppath, f))):
+      modpath = m.group(1).replace('.', '/') + '.qll'
+      for candidate in (normpath(join(dirname(f), modpath)), modpath):
+        if candidate in fileset:
+          deps.add(candidate)
+    graph[f] = deps
+  return graph
+
+
+def affected_ql_files(graph, changed):
+  importers = {}
+  for f, deps in graph.items():
+    for d in deps:
+      importers.setdefault(d, set()).add(f)
+  affected = set(changed)
+  todo = list(changed)
+  while todo:
+    for i in importers.get(todo.pop(), ()):
+      if i not in affected:
+        affected.add(i)
+        todo.append(i)
+  return affected
+
+
+def ql_import_modules(qlfile, modules, visible=False):
+  # import all of the modules which qlfile does not import yet with
+  # the same visibility, reading and appending to the file only once.
+  # Returns the imported modules.
+  qlstr = file2str(qlfile)
+  imported = ql_imported_modules(qlstr)
+  added = []
+  lines = []
+  for module in modules:
+    if (module, visible) in imported:
+      continue
+    imported.add((module, visible))
+    added.append(module)
+    if visible:
+      suffix = ''
+    else:
+      # unique per file and module
+      suffix = f' as {HIDDEN_IMPORT_PREFIX}{hashstr(qlstr + chr(0) + module)}'
+    lines.append(f'\nimport {module}{suffix}')
+
+  if lines:
+    break_link(qlfile)
+    with open(qlfile, 'a') as f:
+      f.write(''.join(lines))
+  return added
+
+
 def ql_import(qlfile, module, visible=False):
-  if visible:
-    suffix = ''
-  else:
-    content_hash = hashstr(file2str(qlfile))
-    suffix = f' as hiddentailorimports{content_hash}'
+  ql_import_modules(qlfile, [module], visible)
+
 
-  with open(qlfile, 'a') as f:
-    f.write(f'\nimport {module}{suffix}')
+def unique_paths(paths):
+  # paths without those resolving to the same file as an earlier one
+  seen = set()
+  result = []
+  for p in paths:
+    rp = realpath(p)
+    if rp not in seen:
+      seen.add(rp)
+      result.append(p)
+  return result
+
+
+def ql_imports(qlfiles, modules, visible=False, workers=None):
+  # ql_import_modules() for all files, on a thread pool; returns the
+  # imported modules per file. Each file is edited only once, repeated
+  # files (which would race with each other) report no imports.
+  qlfiles = list(qlfiles)
+  unique = unique_paths(qlfiles)
+  added = dict(zip(
+    unique,
+    parallel_map(
+      lambda qlf: ql_import_modules(qlf, modules, visible),
+      unique,
+      workers=workers,
+    )
+  ))
+  return [added.pop(qlf, []) for qlf in qlfiles]
 
 
 def normalize_settings(settings):
@@ -1040,38 +2943,54 @@ def hash_settings(settings):
   return h.hexdigest()
 
 
-def customize(ppath, settingsfile, qlfiles, priority, modules):
+def customize(ppath, settingsfile, qlfiles, priority, modules, chunk_size=None):
   with open(settingsfile, 'r') as f:
     settings = normalize_settings(yaml.safe_load(f))
 
-  shutil.copytree(
-    join(commondir(), 'ql', 'tailor'),
-    join(ppath, 'tailor'),
-    dirs_exist_ok=True
-  )
-
+  templates = [join(commondir(), 'ql', 'tailor')]
   if modules is None:
     modules = ['tailor.Customizations']
-    shutil.copytree(
-      join(templatedir(), get_pack_lang(ppath), 'ql', 'tailor'),
-      join(ppath, 'tailor'),
-      dirs_exist_ok=True
-    )
+    templates.append(join(templatedir(), get_pack_lang(ppath), 'ql', 'tailor'))
+
+  copied, skipped = 0, 0
+  for t in templates:
+    tcopied, tskipped = sync_tree(t, join(ppath, 'tailor'))
+    copied, skipped = copied + tcopied, skipped + tskipped
 
   modules.append('tailor.Settings')
 
   usmod = 'UserSettings_%s' % hash_settings(settings)
 
-  str2file(
-    join(ppath, 'tailor', f'{usmod}.qll'),
-    generate_settings_ql(settings, priority, usmod, modules)
+  settingsqll = join(ppath, 'tailor', f'{usmod}.qll')
+  content = generate_settings_ql(
+    settings, priority, usmod, modules, chunk_size
   )
+  if isfile(settingsqll) and file2str(settingsqll) == content:
+    skipped += 1
+  else:
+    str2file(settingsqll, content)
+    copied += 1
 
-  for qlf in qlfiles:
-    ql_import(qlf, f'tailor.{usmod}')
+  imported = sum(
+    1 for added in ql_imports(qlfiles, [f'tailor.{usmod}']) if added
+  )
+  info(
+    f'Customized "{ppath}": {copied} of {copied + skipped} tailor library ' +
+    f'files updated, imports added to {imported} of {len(qlfiles)} files.'
+  )
 
 
-def generate_settings_ql(settings, priority, name, modules):
+# default number of values per predicate when chunking the settings
+# (see integration-tests/settings-benchmark.sh)
+SETTINGS_CHUNK_SIZE = 500
+
+
+def generate_settings_ql(settings, priority, name, modules, chunk_size=None):
+  if chunk_size:
+    return generate_settings_ql_chunked(
+      settings, priority, name, modules, chunk_size
+    )
+
   keyvalues = ' or'.join(
     '\n    k = "{k}" and v = [{values}\n    ]'.format(
       k=k,
@@ -1093,3 +3012,50 @@ def generate_settings_ql(settings, priority, name, modules):
     classname=name,
     keyvalues=keyvalues,
   )
+
+
+def generate_settings_ql_chunked(
+  settings, priority, name, modules, chunk_size=SETTINGS_CHUNK_SIZE
+):
+  # Like generate_settings_ql(), but the values are distributed over
+  # private predicates of at most chunk_size rows each, instead of one
+  # huge disjunction, which can be slow to compile for large settings.
+  rows = [(k, v) for k, vs in settings.items() for v in vs]
+  chunks = []
+  for i in range(0, len(rows), chunk_size):
+    bykey = {}
+    for k, v in rows[i:i + chunk_size]:
+      bykey.setdefault(k, []).append(v)
+    chunks.append(bykey)
+
+  predicates = ''.join(
+    textwrap.dedent('''
+      private predicate assign{i}(string k, string v) {{{keyvalues}
+      }}
+    ''').format(
+      i=i,
+      keyvalues=' or'.join(
+        '\n  k = "{k}" and v = [{values}\n  ]'.format(
+          k=k,
+          values=','.join(f'\n    "{v}"' for v in vs)
+        ) for k, vs in chunk.items()
+      ),
+    ) for i, chunk in enumerate(chunks)
+  )
+
+  return textwrap.dedent('''
+    {modules}
+
+    class {classname} extends Tailor::Settings {{
+      {classname}(){{ this = {priority} }}
+      override predicate assign(string k, string v) {{{assigns}
+      }}
+    }}
+  ''').format(
+    modules='\n'.join(f'import {m}' for m in modules),
+    priority=priority,
+    classname=name,
+    assigns=' or'.join(
+      f'\n    assign{i}(k, v)' for i in range(len(chunks))
+    ),
+  ) + predicates